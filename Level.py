@@ -1,57 +1,456 @@
-import configparser
+import hashlib
+import json
+import os
+import struct
+import threading
+import numpy
 import pygame
 from math import floor
 
+from assets import assets
+from mapfile import parse_map, TileKey
+
+# Directory, relative to the map file, where compiled levels and prerendered
+# backgrounds are cached
+CACHE_DIR = 'cache'
+# Compiled level file layout: magic, header length, JSON header, then the
+# tile indices, the collision mask and the indices of the other layers, all
+# aligned for memory mapping. The last byte of the magic is the version of
+# the format, to be bumped whenever it or the parsing of maps changes:
+# compiled levels of other versions are stale, thus parsed again
+COMPILED_MAGIC = b'LLNLVL\x00\x02'
+COMPILED_ALIGN = 16
+# Number of tile changes a level remembers, see Level.changes_since
+CHANGES_KEPT = 1024
+# Layers of the map drawn on the background, the others (see
+# mapfile.LAYERS) are drawn over entities
+STATIC_LAYERS = ('map', 'decoration')
+# Size of the blocks map files are hashed by
+HASH_BLOCK = 1 << 20
+
+
+class TileCache:
+	"""
+	A cache of the tiles of tilesets, scaled to a given size. Each tile is
+	scaled only once, whatever the number of cells using it.
+	"""
+	def __init__(self):
+		self.tiles = {}
+		# Keys of the tiles scaled from tiles not converted yet, see
+		# Level.convert_tiles
+		self._unconverted = set()
+
+	def get(self,level,tx,ty,size):
+		key = (level.tileset,tx,ty,size)
+		try:
+			return self.tiles[key]
+		except KeyError:
+			surf = level.tiles[tx][ty]
+			# Tiles drawn at their native size are used as they are
+			if surf.get_size() != size:
+				surf = pygame.transform.smoothscale(surf, size)
+			self.tiles[key] = surf
+			if not level.tiles_converted:
+				self._unconverted.add(key)
+			return surf
+
+	def drop_unconverted(self,tileset):
+		"""
+		Drops the tiles of a tileset scaled from tiles not converted yet, so
+		that they are scaled again from the converted ones.
+		"""
+		# Copied at once, the worker thread may add keys meanwhile
+		for key in list(self._unconverted):
+			if key[0] == tileset:
+				self._unconverted.discard(key)
+				self.tiles.pop(key, None)
+
+	def clear(self):
+		self.tiles.clear()
+		self._unconverted.clear()
+
+
+# Cache shared by every level
+tile_cache = TileCache()
+
+
 class Level:
-	def __init__(self, filename):
-		self.map = []
+	"""
+	A level, read from a .map file. Its [level] section gives the tileset,
+	the size of its tiles, and the rows of the ground layer ('map'), and
+	optionally of the 'decoration' and 'overhead' layers, where '-' (and ' '
+	inside rows) are empty cells. Each key char has its own section, whose
+	'tile' attribute is the 'y,x' position of its tile in the tileset, or
+	several space separated positions for an animated tile, whose 'period'
+	attribute is then the number of ticks each frame is shown. See
+	mapfile.parse_map.
+
+	:indices: The (height, width) array of the index in chars of the key
+		char of each cell of the ground.
+	:layers: A dictionary name -> indices of the other layers of the map.
+	:key: A dictionary char -> dictionary of the raw attributes of its key.
+	:key_table: A dictionary char -> mapfile.TileKey of its key.
+	"""
+	def __init__(self, filename, compiled=True):
+		self.read_source(filename)
+		if not (compiled and self.load_compiled()):
+			self.parse(filename)
+			if compiled:
+				self.compile()
+		# The tileset is decoded in the background, it is only needed once
+		# tiles are used, which a prerendered background avoids
+		assets.load_image(self.tileset)
+
+	@property
+	def tiles(self):
+		"""
+		The table of the tiles of the tileset, tiles[tx][ty]. Tiles loaded
+		from the main thread are converted to the pixel format of the display,
+		the ones loaded from another thread (when prefetching the level) are
+		only decoded, until convert_tiles is called.
+		"""
+		if self._tiles is None:
+			self._tiles = self.load_tile_table(self.tileset,self.tile_width,
+				self.tile_height)
+		return self._tiles
+
+	def read_source(self,filename):
+		self.filename = filename
 		self.key = {}
-		parser   = configparser.ConfigParser()
-		parser.read(filename)
-		self.tileset = parser.get("level","tileset")
-		self.map     = parser.get("level","map").split("\n")
-		self.tile_width   = int(parser.get("level","width"))
-		self.tile_height  = int(parser.get("level","height"))
-		self.tiles   = self.load_tile_table(self.tileset,self.tile_width,self.tile_height)
-		for section in parser.sections():
-			if len(section) == 1:
-				self.key[section] = dict(parser.items(section))
-		self.width = len(self.map[0])
-		self.height = len(self.map)
-	
-	def get_tile(self,x,y):
-		try:
-			char = self.map[y][x]
-		except IndexError:
-			return {}
+		self.key_table = {}
+		self.layers = {}
+		self._tiles = None
+		self.tiles_converted = False
+		# Bumped on every tile change, with the log of the changed tiles
+		self.version = 0
+		self.changes = []
+		digest = hashlib.sha1(COMPILED_MAGIC)
+		with open(filename, 'rb') as file:
+			for block in iter(lambda: file.read(HASH_BLOCK), b''):
+				digest.update(block)
+		self.source_hash = digest.hexdigest()
+
+	def parse(self,filename):
+		"""
+		:raise mapfile.MapError: If the map file is not valid.
+		"""
+		data = parse_map(filename)
+		self.tileset = data.tileset
+		self.tile_width = data.tile_width
+		self.tile_height = data.tile_height
+		self.width = data.width
+		self.height = data.height
+		self.key = data.key
+		self.key_table = data.key_table
+		self.chars = data.chars
+		self.indices = data.indices
+		self.layers = data.layers
+		self.blocked = self.build_collision_mask()
+
+	def layer(self,name):
+		"""
+		:param name: The name of a layer, one of mapfile.LAYERS.
+		:return: The indices of the layer, None if the map does not have it.
+		"""
+		if name == 'map':
+			return self.indices
+		return self.layers.get(name)
+
+	def tile_frames(self,char):
+		"""
+		:return: The list of the (tx, ty) positions in the tileset of the
+			frames of the tile of a key char: a single one for static tiles,
+			none for chars without key.
+		"""
+		key = self.key_table.get(char)
+		if key is None:
+			return []
+		return key.frames
+
+	def tile_period(self,char):
+		"""
+		:return: The number of ticks each frame of the tile of a key char is
+			shown, 0 for static tiles.
+		"""
+		key = self.key_table.get(char)
+		if key is None:
+			return 0
+		return key.period
+
+	def exits(self):
+		"""
+		:return: The list of the exits of the level, as (x, y, filename,
+			arrival) tuples: the tile of the exit, the map file it leads to,
+			and the (x, y) tile to arrive on, None if not given. The exits
+			are the tiles whose key has an 'exit' attribute, the path of a
+			map file relative to this one, and optionally an 'arrival'
+			attribute, 'x,y'.
+		"""
+		exits = []
+		directory = os.path.dirname(self.filename)
+		for index, char in enumerate(self.chars):
+			key = self.key_table.get(char)
+			if key is None or key.exit is None:
+				continue
+			filename = os.path.join(directory, key.exit)
+			for y, x in numpy.argwhere(self.indices == index).tolist():
+				exits.append((x, y, filename, key.arrival))
+		return exits
+
+	def cache_path(self,name):
+		return os.path.join(os.path.dirname(self.filename), CACHE_DIR, name)
 
+	def compile(self):
+		"""
+		Writes the compiled version of this level in the cache directory, so
+		that next loads of the same map skip the parsing. Failing to write
+		the cache is not an error.
+		"""
+		header = json.dumps({
+			'source_hash': self.source_hash,
+			'tileset': self.tileset,
+			'tile_width': self.tile_width,
+			'tile_height': self.tile_height,
+			'width': self.width,
+			'height': self.height,
+			'chars': self.chars,
+			'key': self.key,
+			'layers': list(self.layers),
+			}).encode('utf-8')
+		start = len(COMPILED_MAGIC) + 4 + len(header)
+		padding = b'\x00' * (-start % COMPILED_ALIGN)
+		indices = numpy.ascontiguousarray(self.indices, numpy.uint8).tobytes()
+		mask = numpy.ascontiguousarray(self.blocked, numpy.uint8).tobytes()
+		indices += b'\x00' * (-len(indices) % COMPILED_ALIGN)
+		mask += b'\x00' * (-len(mask) % COMPILED_ALIGN)
+		layers = [numpy.ascontiguousarray(layer, numpy.uint8).tobytes()
+			+ b'\x00' * (-layer.size % COMPILED_ALIGN)
+			for layer in self.layers.values()]
+		write_cache(self.cache_path(os.path.basename(self.filename) + '.lvl'),
+			COMPILED_MAGIC, struct.pack('<I', len(header)), header, padding,
+			indices, mask, *layers)
+
+	def load_compiled(self):
+		"""
+		Loads this level from its compiled version, if it exists and is not
+		stale. The tile indices and collision mask are memory mapped.
+
+		:return: True if the compiled level was loaded, False otherwise.
+		"""
+		path = self.cache_path(os.path.basename(self.filename) + '.lvl')
 		try:
-			return self.key[char]
-		except KeyError:
+			with open(path, 'rb') as file:
+				if file.read(len(COMPILED_MAGIC)) != COMPILED_MAGIC:
+					return False
+				length, = struct.unpack('<I', file.read(4))
+				header = json.loads(file.read(length).decode('utf-8'))
+		except (OSError, ValueError, struct.error):
+			return False
+		if header['source_hash'] != self.source_hash:
+			return False
+		offset = len(COMPILED_MAGIC) + 4 + length
+		offset += -offset % COMPILED_ALIGN
+		self.tileset = header['tileset']
+		self.tile_width = header['tile_width']
+		self.tile_height = header['tile_height']
+		self.width = header['width']
+		self.height = header['height']
+		self.chars = header['chars']
+		self.key = header['key']
+		self.key_table = {char: TileKey(char, attributes, self.filename)
+			for char, attributes in self.key.items()}
+		self.indices = numpy.memmap(path, numpy.uint8, 'r', offset,
+			(self.height,self.width))
+		offset += self.indices.nbytes + (-self.indices.nbytes % COMPILED_ALIGN)
+		self.blocked = numpy.memmap(path, numpy.uint8, 'r', offset,
+			(self.height+2,self.width+2))
+		offset += self.blocked.nbytes + (-self.blocked.nbytes % COMPILED_ALIGN)
+		for name in header.get('layers', []):
+			layer = numpy.memmap(path, numpy.uint8, 'r', offset,
+				(self.height,self.width))
+			self.layers[name] = layer
+			offset += layer.nbytes + (-layer.nbytes % COMPILED_ALIGN)
+		return True
+
+	def get_tile(self,x,y):
+		"""
+		:return: The dictionary of the raw attributes of the key of the tile
+			(x,y) of the ground, empty outside of the map.
+		"""
+		if not (0 <= x < self.width and 0 <= y < self.height):
 			return {}
-	
-	def render(self,screen,size):
+		return self.key.get(self.chars[self.indices[y,x]], {})
+
+	def build_collision_mask(self):
+		"""
+		Builds the collision mask of the level from the block attribute of
+		the keys. The mask is padded with a blocking border of one tile, so
+		that any position outside of the map is blocked.
+
+		:return: A (height+2, width+2) uint8 array, 1 where a tile blocks.
+		"""
+		lookup = numpy.array([self.is_blocking(char) for char in self.chars],
+			numpy.uint8)
+		mask = numpy.ones((self.height+2,self.width+2), numpy.uint8)
+		mask[1:-1,1:-1] = lookup[self.indices]
+		# Tiles of the other layers may block too, their empty cells do not
+		for layer in self.layers.values():
+			mask[1:-1,1:-1] |= lookup[layer]
+		return mask
+
+	def is_blocking(self,char):
+		"""
+		:return: True if the tile of a key char can not be walked on, False
+			for chars without key.
+		"""
+		key = self.key_table.get(char)
+		return key is not None and key.block
+
+	def set_tile(self,x,y,char,layer='map'):
+		"""
+		Changes the tile of a cell of the map, and bumps the version of the
+		level. The memory mapped arrays of a compiled level are copied on
+		the first change, the compiled file is left untouched.
+
+		:param char: The key char of the new tile.
+		:param layer: The layer of the tile, one of the layers of the map.
+		"""
+		index = self.chars.find(char)
+		if index < 0:
+			self.chars += char
+			index = len(self.chars) - 1
+		if layer == 'map':
+			if not self.indices.flags.writeable:
+				self.indices = numpy.array(self.indices)
+			self.indices[y,x] = index
+		else:
+			if not self.layers[layer].flags.writeable:
+				self.layers[layer] = numpy.array(self.layers[layer])
+			self.layers[layer][y,x] = index
+		if not self.blocked.flags.writeable:
+			self.blocked = numpy.array(self.blocked)
+		self.blocked[y+1,x+1] = any(self.is_blocking(self.chars[indices[y,x]])
+			for indices in [self.indices] + list(self.layers.values()))
+		self.version += 1
+		self.changes.append((x,y))
+		del self.changes[:-CHANGES_KEPT]
+
+	def changes_since(self,version):
+		"""
+		:param version: A previous version of the level.
+		:return: The list of the (x,y) tiles changed since this version, in
+			order, None if they are no longer known.
+		"""
+		count = self.version - version
+		if count > len(self.changes):
+			return None
+		return self.changes[len(self.changes)-count:]
+
+	def is_blocked(self,x,y):
+		"""
+		:return: True if the tile (x,y) can not be walked on, or is outside of
+			the map.
+		"""
+		x = min(max(x,-1),self.width)
+		y = min(max(y,-1),self.height)
+		return bool(self.blocked[y+1,x+1])
+
+	def are_blocked(self,xs,ys):
+		"""
+		Vectorized version of is_blocked.
+
+		:param xs: An array-like of x coordinates.
+		:param ys: An array-like of y coordinates, same shape as xs.
+		:return: A boolean array telling which tiles are blocked.
+		"""
+		xs = numpy.clip(xs,-1,self.width) + 1
+		ys = numpy.clip(ys,-1,self.height) + 1
+		return self.blocked[ys,xs] != 0
+
+	def render(self,screen,size,cache=tile_cache,prerendered=True,scale=1,
+			layers=STATIC_LAYERS):
+		"""
+		Renders the whole map on a surface, animated tiles showing their
+		first frame.
+
+		:param scale: The integer factor the tiles are scaled down by, to
+			draw on a low resolution frame (see render.FrameScaler).
+		:param layers: The layers drawn, in order. Without the ground, the
+			surface is transparent where no tile is drawn.
+		:return: The surface, None if the map has none of the layers.
+		"""
+		arrays = [self.layer(name) for name in layers]
+		arrays = [array for array in arrays if array is not None]
+		if not arrays:
+			return None
 		width = size[0]; height = size[1]
 		sc_width = screen.get_rect().width
 		sc_height = screen.get_rect().height
 
-		tile_width = int(sc_width / width)
-		tile_height = int(sc_height / height)
+		tile_width = int(sc_width / width) // scale
+		tile_height = int(sc_height / height) // scale
+
+		image = pygame.Surface((self.width*tile_width,self.height*tile_height),
+			0 if 'map' in layers else pygame.SRCALPHA)
 
-		image = pygame.Surface((self.width*tile_width,self.height*tile_height))
+		if prerendered:
+			# Prerendered background, keyed by the content of the map and
+			# tileset, the tile size and the pixel format. Its pixels are read
+			# straight into the background surface.
+			digest = hashlib.sha1(self.source_hash.encode('ascii'))
+			with open(self.tileset, 'rb') as file:
+				digest.update(file.read())
+			digest.update(repr((tile_width, tile_height, image.get_pitch(),
+				image.get_masks(), tuple(layers))).encode('ascii'))
+			path = self.cache_path('bg-' + digest.hexdigest() + '.raw')
+			try:
+				with open(path, 'rb') as file:
+					if file.readinto(image.get_view('0')) == \
+							image.get_pitch()*image.get_height():
+						return image
+			except OSError:
+				pass
 
-		for i in range(0,self.width):
-			for j in range(0,self.height):
-				s = self.get_tile(i,j)['tile'].split(',')
-				ty = int(s[0])
-				tx = int(s[1])
-				surf = self.tiles[tx][ty]
-				surf = pygame.transform.smoothscale(surf, (tile_width,tile_height))
-				image.blit(surf,(i*tile_width,j*tile_height))
+		# Scaled surface of each key, scaled once and blitted on every cell
+		surfs = []
+		for char in self.chars:
+			frames = self.tile_frames(char)
+			surfs.append(cache.get(self,frames[0][0],frames[0][1],
+				(tile_width,tile_height)) if frames else None)
+		for array in arrays:
+			image.blits(((surfs[index],(i*tile_width,j*tile_height))
+				for j, row in enumerate(array.tolist())
+				for i, index in enumerate(row)
+				if surfs[index] is not None), False)
+		if prerendered:
+			write_cache(path, image.get_view('0'))
 		return image
 
+	def convert_tiles(self,cache=tile_cache):
+		"""
+		Converts the tiles loaded from another thread to the pixel format of
+		the display, for fast blits, and drops the tiles of the cache scaled
+		from them. Must be called from the main thread, such as when the
+		level is swapped in.
+		"""
+		if self._tiles is None or self.tiles_converted:
+			return
+		self._tiles = self.load_tile_table(self.tileset,self.tile_width,
+			self.tile_height)
+		cache.drop_unconverted(self.tileset)
+
 	def load_tile_table(self,filename,width,height):
-		image = pygame.image.load(filename).convert()
+		image = assets.image(filename)
+		# Surfaces are only converted from the main thread (see
+		# assets.AssetManager)
+		self.tiles_converted = \
+			threading.current_thread() is threading.main_thread()
+		if self.tiles_converted:
+			# Tiles of the decoration and overhead layers need transparency
+			if image.get_flags() & pygame.SRCALPHA:
+				image = image.convert_alpha()
+			else:
+				image = image.convert()
 		image_width, image_height = image.get_size()
 		tile_table = []
 		for tile_x in range(0, floor(image_width/width)):
@@ -62,3 +461,38 @@ class Level:
 				line.append(image.subsurface(rect))
 		return tile_table
 
+
+def write_cache(path,*chunks):
+	"""
+	Atomically writes the given bytes chunks to a cache file. Caches are
+	optional, so failing to write them is silently ignored.
+	"""
+	tmp = path + '.tmp'
+	try:
+		os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+		with open(tmp, 'wb') as file:
+			for chunk in chunks:
+				file.write(chunk)
+		os.replace(tmp, path)
+	except OSError:
+		pass
+
+
+def compile_level(filename):
+	"""
+	Compiles a .map file into the cache directory, next to it.
+
+	:return: The compiled Level.
+	"""
+	# Tiles are not loaded, so that no display is needed
+	level = Level.__new__(Level)
+	level.read_source(filename)
+	level.parse(filename)
+	level.compile()
+	return level
+
+
+if __name__ == "__main__":
+	import sys
+	for filename in sys.argv[1:]:
+		compile_level(filename)
@@ -0,0 +1,221 @@
+import numpy
+import pygame
+
+
+class TileAnimation:
+    """
+    The surfaces of the tiles of a level, scaled to a tile size, showing the
+    current frame of the animated tiles (see Level.tile_frames).
+
+    :level: The Level of the tiles.
+    :tilesize: The size of the tiles, in pixels.
+    :tick: The tick the frames shown are the ones of.
+    :step: The number of times frames changed so far. What was drawn at a
+        previous step may show previous frames of the animated tiles.
+    :surfs: For each tile index of the level, the surface of its current
+        frame, None for chars without key.
+    """
+
+    def __init__(self, level, cache, tilesize):
+        self.level = level
+        self.tilesize = tilesize
+        self.tick = 0
+        self.step = 0
+        self.surfs = []
+        self._cache = cache
+        # Frames and period of each tile index, and the animated indices
+        self._frames = []
+        self._periods = []
+        self._animated = []
+        self.add_tiles()
+
+    def add_tiles(self):
+        """
+        Adds the tiles of the chars added to the level since last call.
+        """
+        level = self.level
+        for char in level.chars[len(self.surfs):]:
+            index = len(self.surfs)
+            self._frames.append([
+                self._cache.get(level, tx, ty, self.tilesize)
+                for tx, ty in level.tile_frames(char)])
+            self._periods.append(level.tile_period(char))
+            if self._periods[index] > 0:
+                self._animated.append(index)
+            self.surfs.append(self._frame(index))
+
+    def _frame(self, index):
+        frames = self._frames[index]
+        if not frames:
+            return None
+        period = self._periods[index]
+        if period <= 0:
+            return frames[0]
+        return frames[self.tick // period % len(frames)]
+
+    @property
+    def animated(self):
+        """
+        The list of the tile indices of the animated tiles.
+        """
+        return self._animated
+
+    def update(self, tick):
+        """
+        Moves the animation to a tick.
+
+        :return: True if frames changed.
+        """
+        self.tick = tick
+        changed = False
+        for index in self._animated:
+            surf = self._frame(index)
+            if surf is not self.surfs[index]:
+                self.surfs[index] = surf
+                changed = True
+        if changed:
+            self.step += 1
+        return changed
+
+
+def draw_cells(surface, animation, arrays, cells, origin=(0, 0)):
+    """
+    Draws the current tiles of cells of a level on a surface, over an
+    emptied cell: black, or transparent for surfaces with alpha.
+
+    :param surface: The surface to draw on.
+    :param animation: The TileAnimation of the level.
+    :param arrays: The indices of the layers drawn, in order.
+    :param cells: An iterable of the (x, y) cells to draw.
+    :param origin: The position of the surface on the whole map, in pixels.
+    :return: The list of the pygame.Rect of the cells on the whole map.
+    """
+    tile_w, tile_h = animation.tilesize
+    surfs = animation.surfs
+    rects = []
+    blits = []
+    for x, y in cells:
+        rect = pygame.Rect(x * tile_w, y * tile_h, tile_w, tile_h)
+        rects.append(rect)
+        position = rect.x - origin[0], rect.y - origin[1]
+        surface.fill(0, (position, rect.size))
+        for array in arrays:
+            surf = surfs[array[y, x]]
+            if surf is not None:
+                blits.append((surf, position))
+    surface.blits(blits, 0)
+    return rects
+
+
+class AnimatedCells:
+    """
+    The cells showing animated tiles on some layers of a level, grouped in
+    square blocks of cells, so that a prerendered surface of these layers
+    is kept up to date by redrawing only the animated cells of its visible
+    blocks, once per animation step.
+
+    :block_size: The number of cells on each side of a block.
+    """
+
+    def __init__(self, level, animation, layers, block_size=16):
+        self.level = level
+        self.animation = animation
+        self.layers = layers
+        self.block_size = block_size
+        # block -> animation step its cells were drawn at
+        self._drawn = {}
+        # block -> set of the animated (x, y) cells of the block
+        self._cells = {}
+        self._version = level.version
+        self._count = len(animation.animated)
+        self._add_cells()
+
+    def arrays(self):
+        """
+        :return: The indices of the layers, in order.
+        """
+        arrays = (self.level.layer(name) for name in self.layers)
+        return [array for array in arrays if array is not None]
+
+    def _animated(self, array):
+        return numpy.isin(array, self.animation.animated)
+
+    def _add_cells(self):
+        arrays = self.arrays()
+        if not arrays or not self.animation.animated:
+            return
+        mask = numpy.zeros(arrays[0].shape, bool)
+        for array in arrays:
+            mask |= self._animated(array)
+        for y, x in numpy.argwhere(mask).tolist():
+            self._add_cell(x, y)
+
+    def _add_cell(self, x, y):
+        block = x // self.block_size, y // self.block_size
+        self._cells.setdefault(block, set()).add((x, y))
+
+    def _follow_changes(self):
+        # Tiles changed since last call may be, or no longer be, animated
+        level = self.level
+        if level.version == self._version:
+            return
+        self.animation.add_tiles()
+        changes = level.changes_since(self._version)
+        if changes is None or len(self.animation.animated) != self._count:
+            self._cells.clear()
+            self._add_cells()
+        else:
+            arrays = self.arrays()
+            animated = self.animation.animated
+            for x, y in changes:
+                block = x // self.block_size, y // self.block_size
+                cells = self._cells.get(block)
+                if cells is not None:
+                    cells.discard((x, y))
+                if any(array[y, x] in animated for array in arrays):
+                    self._add_cell(x, y)
+        self._version = level.version
+        self._count = len(self.animation.animated)
+
+    def mark(self, block):
+        """
+        Records that a block was just drawn with the current frames.
+        """
+        self._drawn[block] = self.animation.step
+
+    def refresh(self, surface, blocks, origin=(0, 0)):
+        """
+        Redraws the animated cells of blocks drawn at a previous step.
+
+        :param surface: The surface the blocks are drawn on.
+        :param blocks: An iterable of the (bx, by) blocks to refresh.
+        :param origin: The position of the surface on the whole map, in
+            pixels.
+        :return: The list of the pygame.Rect of the redrawn cells on the
+            whole map.
+        """
+        self._follow_changes()
+        step = self.animation.step
+        rects = []
+        for block in blocks:
+            if self._drawn.get(block) == step:
+                continue
+            self._drawn[block] = step
+            cells = self._cells.get(block)
+            if cells:
+                rects.extend(draw_cells(surface, self.animation, self.arrays(),
+                                        cells, origin))
+        return rects
+
+    def block_range(self, area):
+        """
+        :param area: A pygame.Rect of the whole map, in pixels.
+        :return: The list of the (bx, by) blocks overlapping it.
+        """
+        block_w = self.block_size * self.animation.tilesize[0]
+        block_h = self.block_size * self.animation.tilesize[1]
+        return [(bx, by)
+                for bx in range(area.left // block_w,
+                                -(-area.right // block_w))
+                for by in range(area.top // block_h,
+                                -(-area.bottom // block_h))]
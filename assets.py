@@ -0,0 +1,103 @@
+import concurrent.futures
+import os
+
+import pygame
+
+
+def read_file(filename):
+    with open(filename, 'rb') as file:
+        return file.read()
+
+
+class AssetManager:
+    """
+    Loads the assets of the game (images and raw file contents, such as
+    music) on a pool of threads, so that they are decoded in parallel, and
+    while the game does something else. Assets are memoized: each file is
+    loaded only once, every request for it returns the same Future.
+
+    Assets should be requested as early as possible with the load_* methods,
+    which do not block, and fetched when needed, which blocks only if they
+    are still loading.
+
+    Images are returned as decoded by pygame.image.load: they must be
+    converted (convert or convert_alpha) by the caller, from the main thread.
+
+    :workers: The number of loading threads.
+    """
+
+    def __init__(self, workers=None):
+        self.workers = workers or min(4, os.cpu_count() or 1)
+        # (kind, filename) -> Future of the asset
+        self._assets = {}
+        self._executor = None
+
+    def _load(self, kind, function, filename):
+        future = self._assets.get((kind, filename))
+        if future is None:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    self.workers, thread_name_prefix='assets')
+            future = self._assets[(kind, filename)] = self._executor.submit(
+                function, filename)
+        return future
+
+    def load_image(self, filename):
+        """
+        Starts loading an image, if it was not already.
+
+        :return: The Future of the pygame.Surface of the image.
+        """
+        return self._load('image', pygame.image.load, filename)
+
+    def load_data(self, filename):
+        """
+        Starts reading a file, if it was not already.
+
+        :return: The Future of the bytes of the file.
+        """
+        return self._load('data', read_file, filename)
+
+    def preload(self, filenames):
+        """
+        Starts loading images.
+        """
+        for filename in filenames:
+            self.load_image(filename)
+
+    def image(self, filename):
+        """
+        :return: The decoded image, waiting for it if it is still loading.
+        """
+        return self.load_image(filename).result()
+
+    def data(self, filename):
+        """
+        :return: The bytes of the file, waiting for them if still loading.
+        """
+        return self.load_data(filename).result()
+
+    def progress(self):
+        """
+        :return: The (loaded, requested) numbers of assets.
+        """
+        loaded = sum(future.done() for future in self._assets.values())
+        return loaded, len(self._assets)
+
+    def clear(self):
+        """
+        Forgets every loaded asset.
+        """
+        self._assets.clear()
+
+    def shutdown(self):
+        """
+        Stops the loading threads, once the pending loads are done.
+        """
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+
+# Asset manager shared by every module
+assets = AssetManager()
@@ -0,0 +1,434 @@
+"""
+Benchmarks of the game loop, comparing the asynchronous design (LlnRpg.play,
+gathering the asynchronous loop functions) to its synchronous equivalent
+(LlnRpg.play_sync).
+
+Each run plays the same scripted session: arrow keys are pressed and
+released at fixed times by a separate thread, then the game is quit. The
+following is measured for every run:
+- the frame time distribution, from the time between two display flips,
+- the input-to-screen latency, from the time an input is posted to the first
+  flip showing it has been handled,
+- the CPU utilisation, as process time over wall time,
+- the number of event loop wakeups per second.
+
+Runs are swept over the number of entities on the map and over base_delay,
+and results are written as JSON.
+
+With --metrics-overhead, the cost of the metrics instrumentation is measured
+instead, as the extra time per frame with metrics, relative to the frame
+time without metrics and to the frame budget at 60 frames per second. The
+target of the instrumentation, under 1%, is taken relative to that budget:
+frames are drawn back to back here, and only last a fraction of it. The
+metrics are collected once a second by the monitoring loop, out of the
+frames: the time of a collection (of 60 frames of metrics) is measured
+apart, relative to the second it happens every.
+
+With --parse-map, the parsing of a generated SIZE x SIZE map is measured
+instead, as the parse time and the peak of the memory allocated by Python,
+for the streaming parser (mapfile.parse_map) and for configparser.
+
+Usage: python bench.py [-o results.json] [--duration 3] [--entities 0 100]
+       [--base-delays 1e-3 1e-2] [--designs async sync]
+       [--metrics-overhead FRAMES] [--parse-map [SIZE]]
+"""
+import argparse
+import asyncio
+import configparser
+import contextlib
+import importlib
+import io
+import json
+import os
+import platform
+import random
+import selectors
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+# Benchmarks run without a real display nor sound card
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+import numpy
+import pygame
+import pygame.locals
+
+from entities import Coin
+from mapfile import parse_map
+
+rpg = importlib.import_module('rpg-lln')
+
+# Keys pressed in turn during the session
+SESSION_KEYS = [pygame.locals.K_RIGHT, pygame.locals.K_DOWN,
+                pygame.locals.K_LEFT, pygame.locals.K_UP]
+# Time between two key presses, and time a key is held, in seconds
+SESSION_PERIOD = 0.2
+SESSION_HOLD = 0.1
+
+
+class CountingSelector(selectors.DefaultSelector):
+    """
+    A selector counting how many times the event loop using it woke up.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.wakeups = 0
+
+    def select(self, timeout=None):
+        events = super().select(timeout)
+        self.wakeups += 1
+        return events
+
+
+def summary(values, scale=1e3):
+    """
+    :param values: A list of durations in seconds.
+    :param scale: Factor applied to the values (ms by default).
+    :return: A dictionary describing the distribution of the values.
+    """
+    if not values:
+        return None
+    values = numpy.multiply(values, scale)
+    return {
+        'count': len(values),
+        'mean': float(numpy.mean(values)),
+        'p50': float(numpy.percentile(values, 50)),
+        'p90': float(numpy.percentile(values, 90)),
+        'p99': float(numpy.percentile(values, 99)),
+        'max': float(numpy.max(values)),
+        }
+
+
+def session(duration):
+    """
+    :param duration: The duration of the session, in seconds.
+    :return: The scripted session, a list of (time, event) sorted by time.
+    """
+    script = []
+    for i in range(int(duration / SESSION_PERIOD)):
+        key = SESSION_KEYS[i % len(SESSION_KEYS)]
+        t = i * SESSION_PERIOD
+        script.append((t, pygame.event.Event(pygame.locals.KEYDOWN, key=key)))
+        script.append((t + SESSION_HOLD,
+                       pygame.event.Event(pygame.locals.KEYUP, key=key)))
+    script.append((duration, pygame.event.Event(pygame.QUIT)))
+    return script
+
+
+def is_handled(game, event):
+    """
+    :return: True if the game state shows the given scripted event was
+        handled.
+    """
+    if event.type == pygame.QUIT:
+        return not game.running
+    pressed = game.raw_direction[game.key_direction_mapping[event.key]] > 0
+    return pressed == (event.type == pygame.locals.KEYDOWN)
+
+
+def add_coins(game, number, seed=0):
+    """
+    Adds coins on random walkable tiles of the game's map.
+    """
+    rng = random.Random(seed)
+    ys, xs = numpy.nonzero(game.grid.level.blocked[1:-1, 1:-1] == 0)
+    size = tuple(numpy.multiply(game.grid.tilesize, 0.75))
+    for _ in range(number):
+        i = rng.randrange(len(xs))
+        coin = Coin(size, 10)
+        coin.load_sprites('res/coin.png', 1, 1, game.grid.scale,
+                          game.grid.atlas)
+        coin.set_pos(game.grid, (int(xs[i]), int(ys[i])))
+        game.grid.add_entity(coin)
+
+
+def run(design, entities, base_delay, duration):
+    """
+    Plays the scripted session once.
+
+    :param design: 'async' or 'sync'.
+    :param entities: The number of coins added to the map.
+    :param base_delay: The base_delay of the game.
+    :param duration: The duration of the session, in seconds.
+    :return: A dictionary of the measures.
+    """
+    game = rpg.LlnRpg(base_delay=base_delay, music_file=None)
+    add_coins(game, entities)
+    pygame.init()
+    game.toggle_sound()
+    game.setup_events()
+    pygame.event.clear()
+
+    script = session(duration)
+    pending = []  # (post time, event) waiting to be shown on screen
+    latencies = []
+    flips = []
+    flip = pygame.display.flip
+
+    def timed_flip():
+        flip()
+        now = time.perf_counter()
+        flips.append(now)
+        while pending and is_handled(game, pending[0][1]):
+            latencies.append(now - pending.pop(0)[0])
+
+    def post_inputs():
+        start = time.perf_counter()
+        for t, event in script:
+            time.sleep(max(0.0, start + t - time.perf_counter()))
+            pending.append((time.perf_counter(), event))
+            pygame.event.post(event)
+
+    # Measures stop once the game has handled the quit event, so that the
+    # shutdown of the loops is not measured
+    stop = {}
+    wakeups = [0]
+    selector = CountingSelector()
+    handle_event = game.handle_event
+    poll_events = game.poll_events
+
+    def timed_handle_event(event):
+        handle_event(event)
+        if not game.running and not stop:
+            stop['wall'] = time.perf_counter()
+            stop['cpu'] = time.process_time()
+            stop['wakeups'] = selector.wakeups + wakeups[0]
+
+    def counting_poll_events():
+        # Each iteration of the synchronous loop polls the events once
+        wakeups[0] += 1
+        poll_events()
+
+    game.handle_event = timed_handle_event
+    if design == 'sync':
+        game.poll_events = counting_poll_events
+    poster = threading.Thread(target=post_inputs, daemon=True)
+    pygame.display.flip = timed_flip
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            wall, cpu = time.perf_counter(), time.process_time()
+            poster.start()
+            if design == 'async':
+                loop = asyncio.SelectorEventLoop(selector)
+                try:
+                    loop.run_until_complete(game.play())
+                finally:
+                    loop.close()
+            else:
+                game.play_sync()
+            poster.join()
+            wall = stop['wall'] - wall
+            cpu = stop['cpu'] - cpu
+    finally:
+        pygame.display.flip = flip
+
+    return {
+        'design': design,
+        'entities': entities,
+        'base_delay': base_delay,
+        'wall_time': wall,
+        'frames': len(flips),
+        'fps': len(flips) / wall,
+        'frame_time_ms': summary(numpy.diff(flips).tolist()),
+        'latency_ms': summary(latencies),
+        'cpu_utilisation': cpu / wall,
+        'wakeups_per_second': stop['wakeups'] / wall,
+        }
+
+
+def metrics_overhead(entities, frames, repeat=5):
+    """
+    Measures the overhead of the metrics instrumentation, by drawing frames
+    back to back with and without metrics, then the time of a collection of
+    the metrics of 60 frames. Every frame runs a single tick.
+
+    :param entities: The number of coins added to the map.
+    :param frames: The number of frames of each measure.
+    :param repeat: The number of measures.
+    :return: A dictionary of the measures.
+    """
+    game = rpg.LlnRpg(music_file=None, target_fps=None, tick_rate=1e6,
+                      max_ticks=1)
+    add_coins(game, entities)
+    pygame.init()
+    game.toggle_sound()
+    # Frames are drawn in short blocks, alternately with and without metrics,
+    # so that both see the same conditions, and the median block is kept
+    block = min(frames, 100)
+    block_times = {False: [], True: []}
+    for index in range(repeat * max(1, frames // block)):
+        for enabled in (False, True) if index % 2 else (True, False):
+            game.metrics.enabled = enabled
+            start = time.perf_counter()
+            for _ in range(block):
+                game.frame()
+            block_times[enabled].append((time.perf_counter() - start) / block)
+            # Collected apart, as by the monitoring loop
+            game.metrics.collect(1.0)
+    frame_times = {enabled: statistics.median(times)
+                   for enabled, times in block_times.items()}
+    # The monitoring loop collects the metrics once a second
+    game.metrics.enabled = True
+    game.metrics.collect(1.0)
+    collect_time = None
+    for _ in range(repeat):
+        for _ in range(60):
+            game.frame()
+        start = time.perf_counter()
+        game.report_monitoring(1.0)
+        elapsed = time.perf_counter() - start
+        collect_time = min(collect_time or elapsed, elapsed)
+    overhead = frame_times[True] - frame_times[False]
+    return {
+        'entities': entities,
+        'frame_time_ms': 1e3 * frame_times[False],
+        'instrumented_frame_time_ms': 1e3 * frame_times[True],
+        'overhead_us': 1e6 * overhead,
+        'overhead': overhead / frame_times[False],
+        'budget_overhead': 60 * overhead,
+        'collect_us': 1e6 * collect_time,
+        'collect_overhead': collect_time,
+        }
+
+
+def write_map(filename, size, seed=0):
+    """
+    Writes a size x size map of random grass, stones and walls, row by row.
+    """
+    keys = {'.': '0,1', 'o': '1,0', '*': '0,0'}
+    codes = numpy.frombuffer(''.join(keys).encode('ascii'), numpy.uint8)
+    rng = numpy.random.default_rng(seed)
+    with open(filename, 'w') as file:
+        file.write('[level]\ntileset = images/tile_set.png\n'
+                   'width = 16\nheight = 16\nmap:')
+        for _ in range(size):
+            row = codes[rng.integers(len(codes), size=size)]
+            file.write('\t%s\n' % row.tobytes().decode('ascii'))
+        for char, tile in keys.items():
+            file.write('\n[%s]\ntile = %s\nblock = %d\n'
+                       % (char, tile, char == '*'))
+
+
+def parse_with_configparser(filename):
+    """
+    Parses a map with configparser, as levels were parsed before
+    mapfile.parse_map: into the list of its rows, then the array of the
+    tile indices.
+    """
+    parser = configparser.ConfigParser()
+    parser.read(filename)
+    rows = parser.get('level', 'map').split('\n')
+    cells = numpy.frombuffer(''.join(rows).encode('latin-1'), numpy.uint8)
+    indices = numpy.unique(cells, return_inverse=True)[1]
+    return indices.astype(numpy.uint8).reshape(len(rows), -1)
+
+
+def parse_map_benchmark(size, repeat=3):
+    """
+    Measures the parsing of a generated size x size map.
+
+    :param repeat: The number of measures of each parser, the best time is
+        kept.
+    :return: A dictionary of the measures.
+    """
+    result = {'size': size, 'cells': size * size}
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'bench.map')
+        write_map(filename, size)
+        result['file_bytes'] = os.path.getsize(filename)
+        for name, parse in (('mapfile', parse_map),
+                            ('configparser', parse_with_configparser)):
+            times = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                parse(filename)
+                times.append(time.perf_counter() - start)
+            # Measured apart, tracing allocations slows the parsing down
+            tracemalloc.start()
+            parse(filename)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            result[name] = {
+                'parse_time_s': min(times),
+                'peak_memory_bytes': peak,
+                'peak_bytes_per_cell': peak / (size * size),
+                }
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-o', '--output', help='JSON file to write results '
+                        'to (standard output by default)')
+    parser.add_argument('--duration', type=float, default=3.0,
+                        help='duration of each session, in seconds')
+    parser.add_argument('--entities', type=int, nargs='+', default=[0, 100],
+                        help='numbers of entities to sweep over')
+    parser.add_argument('--base-delays', type=float, nargs='+',
+                        default=[1e-3, 1e-2],
+                        help='base_delay values to sweep over')
+    parser.add_argument('--designs', nargs='+', default=['async', 'sync'],
+                        choices=['async', 'sync'])
+    parser.add_argument('--metrics-overhead', type=int, metavar='FRAMES',
+                        help='measure the overhead of the metrics over FRAMES '
+                             'frames instead')
+    parser.add_argument('--parse-map', type=int, nargs='?', const=4096,
+                        metavar='SIZE', help='measure the parsing of a SIZE x '
+                        'SIZE map instead (4096 by default)')
+    args = parser.parse_args()
+
+    results = []
+    if args.parse_map is not None:
+        result = parse_map_benchmark(args.parse_map)
+        results.append(result)
+        for name in ('mapfile', 'configparser'):
+            print('%-12s size=%d parse=%.2fs peak memory=%.1fMB '
+                  '(%.2f bytes/cell)' % (
+                      name, args.parse_map, result[name]['parse_time_s'],
+                      result[name]['peak_memory_bytes'] / 1e6,
+                      result[name]['peak_bytes_per_cell']), file=sys.stderr)
+        args.entities = []
+    for entities in args.entities:
+        if args.metrics_overhead is not None:
+            result = metrics_overhead(entities, args.metrics_overhead)
+            results.append(result)
+            print('entities=%-6d frame=%.3fms metrics overhead=%.1fus '
+                  '(%.2f%% of frame, %.3f%% of 60 fps budget, target 1%%), '
+                  'collection out of frames=%.0fus (%.3f%% of each second)'
+                  % (entities, result['frame_time_ms'], result['overhead_us'],
+                     100 * result['overhead'], 100 * result['budget_overhead'],
+                     result['collect_us'], 100 * result['collect_overhead']),
+                  file=sys.stderr)
+            continue
+        for base_delay in args.base_delays:
+            for design in args.designs:
+                result = run(design, entities, base_delay, args.duration)
+                results.append(result)
+                print('%-5s entities=%-6d base_delay=%-6g fps=%6.1f '
+                      'cpu=%5.1f%% wakeups/s=%7.1f' % (
+                          design, entities, base_delay, result['fps'],
+                          100 * result['cpu_utilisation'],
+                          result['wakeups_per_second']), file=sys.stderr)
+    report = {
+        'python': platform.python_version(),
+        'pygame': pygame.version.ver,
+        'platform': platform.platform(),
+        'duration': args.duration,
+        'results': results,
+        }
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
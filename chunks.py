@@ -0,0 +1,242 @@
+from collections import OrderedDict
+
+import pygame
+
+from Level import STATIC_LAYERS
+from animation import AnimatedCells, TileAnimation
+from profiling import profiler
+
+
+class ChunkedBackground:
+    """
+    The background of a level split into square chunks of tiles, rendered
+    lazily when the view gets close to them, instead of a single surface
+    covering the whole map. Rendered chunks are kept in a LRU cache bounded
+    by a memory budget, so memory does not depend on the size of the map.
+
+    Chunks are rendered from the tile indices of the level, which are memory
+    mapped for compiled levels: only the parts of the map that are seen are
+    read. Chunks ahead of the view in the direction of movement are
+    prefetched a few at a time on every frame, so that scrolling does not
+    have to render chunks synchronously.
+
+    Animated tiles are rendered with their current frame, and the animated
+    cells of the visible chunks are redrawn when their frame changes (see
+    animate).
+
+    :level: The Level to render.
+    :layers: The layers of the level rendered, in order. Without the
+        ground, chunks are transparent where no tile is drawn.
+    :tilesize: The size of the tiles on the screen, in pixels.
+    :chunk_size: The number of tiles on each side of a chunk.
+    :memory_budget: The maximal number of bytes of the cached chunks. Visible
+        chunks are always kept, even over budget.
+    :lookahead: The number of chunks prefetched ahead of the view.
+    :prefetch_per_frame: The maximal number of chunks prefetched per frame.
+    :misses: The number of chunks that had to be rendered synchronously
+        because they were not ready when needed.
+    :renders: The number of chunks rendered so far.
+    """
+
+    def __init__(self, level, tilesize, cache, chunk_size=16,
+                 memory_budget=64 * 2**20, lookahead=1, prefetch_per_frame=1,
+                 layers=STATIC_LAYERS):
+        self.level = level
+        self.layers = layers
+        self.tilesize = tilesize
+        self.chunk_size = chunk_size
+        self.memory_budget = memory_budget
+        self.lookahead = lookahead
+        self.prefetch_per_frame = prefetch_per_frame
+        self.misses = 0
+        self.renders = 0
+        self.memory = 0
+        # (cx, cy) -> Surface, least recently used first
+        self._chunks = OrderedDict()
+        self._visible = set()
+        # Scaled tile surfaces of the level, and its animated cells by chunk
+        self.animation = TileAnimation(level, cache, tilesize)
+        self._cells = AnimatedCells(level, self.animation, layers, chunk_size)
+        self.width = -(-level.width // chunk_size)
+        self.height = -(-level.height // chunk_size)
+
+    def invalidate(self, x, y):
+        """
+        Drops the chunk of a tile that changed, so that it is rendered again.
+
+        :param x: The horizontal index of the tile.
+        :param y: The vertical index of the tile.
+        """
+        self.animation.add_tiles()
+        chunk = self._chunks.pop((x // self.chunk_size, y // self.chunk_size),
+                                 None)
+        if chunk is not None:
+            self.memory -= chunk.get_bytesize() * chunk.get_width() \
+                * chunk.get_height()
+
+    def get_size(self):
+        """
+        :return: The size in pixels of the whole background.
+        """
+        return (self.level.width * self.tilesize[0],
+                self.level.height * self.tilesize[1])
+
+    def get_rect(self):
+        return pygame.Rect((0, 0), self.get_size())
+
+    def render(self, cx, cy):
+        """
+        Renders a chunk.
+
+        :param cx: The horizontal index of the chunk.
+        :param cy: The vertical index of the chunk.
+        :return: The Surface of the chunk.
+        """
+        with profiler.scope('level.chunk'):
+            tile_w, tile_h = self.tilesize
+            size = self.chunk_size
+            image = None
+            surfs = self.animation.surfs
+            for array in self._cells.arrays():
+                indices = array[cy * size:(cy + 1) * size,
+                                cx * size:(cx + 1) * size]
+                if image is None:
+                    height, width = indices.shape
+                    image = pygame.Surface(
+                        (width * tile_w, height * tile_h),
+                        0 if 'map' in self.layers else pygame.SRCALPHA)
+                image.blits(((surfs[index], (i * tile_w, j * tile_h))
+                             for j, row in enumerate(indices.tolist())
+                             for i, index in enumerate(row)
+                             if surfs[index] is not None), 0)
+        self._cells.mark((cx, cy))
+        self.renders += 1
+        return image
+
+    def get_chunk(self, cx, cy):
+        """
+        :return: The Surface of a chunk, rendered if it was not cached.
+        """
+        chunk = self._chunks.get((cx, cy))
+        if chunk is None:
+            chunk = self._store((cx, cy), self.render(cx, cy))
+        else:
+            self._chunks.move_to_end((cx, cy))
+        return chunk
+
+    def _store(self, key, chunk):
+        self._chunks[key] = chunk
+        self.memory += chunk.get_bytesize() * chunk.get_width() \
+            * chunk.get_height()
+        # Evict least recently used chunks, but never visible ones
+        for old in list(self._chunks):
+            if self.memory <= self.memory_budget:
+                break
+            if old in self._visible or old == key:
+                continue
+            old_chunk = self._chunks.pop(old)
+            self.memory -= old_chunk.get_bytesize() * old_chunk.get_width() \
+                * old_chunk.get_height()
+        return chunk
+
+    def chunk_range(self, view_coord, screen_size):
+        """
+        :return: The (cx0, cy0, cx1, cy1) range of the chunks visible for the
+            given view, cx1 and cy1 excluded.
+        """
+        chunk_w = self.chunk_size * self.tilesize[0]
+        chunk_h = self.chunk_size * self.tilesize[1]
+        cx0 = max(0, -view_coord[0] // chunk_w)
+        cy0 = max(0, -view_coord[1] // chunk_h)
+        cx1 = min(self.width, -((view_coord[0] - screen_size[0]) // chunk_w))
+        cy1 = min(self.height, -((view_coord[1] - screen_size[1]) // chunk_h))
+        return cx0, cy0, cx1, cy1
+
+    def draw(self, screen, view_coord):
+        """
+        Draws the visible chunks of the background on the screen. Missing
+        chunks are rendered synchronously.
+
+        :param screen: The surface to draw on.
+        :param view_coord: The view's coordinates of the grid.
+        """
+        screen.blits(self.blits(view_coord, screen.get_size()), 0)
+
+    def blits(self, view_coord, screen_size):
+        """
+        :param view_coord: The view's coordinates of the grid.
+        :param screen_size: The size of the screen, in pixels.
+        :return: The list of the (chunk surface, screen position) of the
+            visible chunks, to be blitted. Missing chunks are rendered
+            synchronously.
+        """
+        cx0, cy0, cx1, cy1 = self.chunk_range(view_coord, screen_size)
+        self._visible = {(cx, cy) for cx in range(cx0, cx1)
+                         for cy in range(cy0, cy1)}
+        chunk_w = self.chunk_size * self.tilesize[0]
+        chunk_h = self.chunk_size * self.tilesize[1]
+        blits = []
+        for cx, cy in self._visible:
+            if (cx, cy) not in self._chunks:
+                self.misses += 1
+            blits.append((self.get_chunk(cx, cy),
+                          (cx * chunk_w + view_coord[0],
+                           cy * chunk_h + view_coord[1])))
+        return blits
+
+    def animate(self, tick, view_coord, screen_size):
+        """
+        Moves the animated tiles to a tick, and redraws the animated cells of
+        the visible chunks drawn with previous frames.
+
+        :param tick: The current tick.
+        :param view_coord: The view's coordinates of the grid.
+        :param screen_size: The size of the screen, in pixels.
+        :return: The list of the pygame.Rect of the screen redrawn.
+        """
+        self.animation.update(tick)
+        cx0, cy0, cx1, cy1 = self.chunk_range(view_coord, screen_size)
+        chunk_w = self.chunk_size * self.tilesize[0]
+        chunk_h = self.chunk_size * self.tilesize[1]
+        rects = []
+        for cx in range(cx0, cx1):
+            for cy in range(cy0, cy1):
+                chunk = self._chunks.get((cx, cy))
+                if chunk is not None:
+                    rects.extend(self._cells.refresh(
+                        chunk, [(cx, cy)], (cx * chunk_w, cy * chunk_h)))
+        return [rect.move(view_coord) for rect in rects]
+
+    def prefetch(self, view_coord, screen_size, direction):
+        """
+        Renders a few of the chunks the view is moving towards, or of the
+        visible chunks when it does not move, if they are not cached yet.
+        Should be called once per frame.
+
+        :param view_coord: The view's coordinates of the grid.
+        :param screen_size: The size of the screen, in pixels.
+        :param direction: The direction the view moves to, 1: UP, 2: DOWN,
+            3: LEFT, 4: RIGHT, 0 for none.
+        """
+        cx0, cy0, cx1, cy1 = self.chunk_range(view_coord, screen_size)
+        ahead = self.lookahead
+        if direction == 1:
+            cy0, cy1 = cy0 - ahead, cy0
+        elif direction == 2:
+            cy0, cy1 = cy1, cy1 + ahead
+        elif direction == 3:
+            cx0, cx1 = cx0 - ahead, cx0
+        elif direction == 4:
+            cx0, cx1 = cx1, cx1 + ahead
+        queue = [(cx, cy) for cx in range(max(0, cx0), min(self.width, cx1))
+                 for cy in range(max(0, cy0), min(self.height, cy1))]
+        queue = [key for key in queue if key not in self._chunks]
+        for cx, cy in queue[:self.prefetch_per_frame]:
+            self._store((cx, cy), self.render(cx, cy))
+
+    def clear(self):
+        """
+        Drops every cached chunk.
+        """
+        self._chunks.clear()
+        self.memory = 0
@@ -0,0 +1,103 @@
+import time
+
+
+class GameClock:
+    """
+    A game clock decoupling the simulation from the rendering. The game is
+    simulated by fixed-rate ticks, whatever the frame rate: on each frame,
+    the real time elapsed since last frame is added to an accumulator, and
+    as many ticks as it holds are run. The number of ticks per frame is
+    capped, so that a slow frame does not lead to ever slower frames (the
+    spiral of death), the game slows down instead.
+
+    Frames are paced to a target frame rate. The clock also measures where
+    the time of each frame goes.
+
+    :tick_rate: The number of simulation ticks per second.
+    :target_fps: The number of frames per second to aim at, None to draw
+        frames as fast as possible (with vsync, flip is then the limit).
+    :max_ticks: The maximal number of ticks run in a single frame.
+    :alpha: The fraction of a tick the accumulator holds after the ticks of
+        the frame were run, to interpolate positions between the last two
+        ticks.
+    :due: The time (from time.perf_counter) the next frame is due.
+    :timings: The timing of the last frame, in milliseconds: 'update',
+        'draw', 'present', 'frame', 'interval' (since the end of the
+        previous frame), 'sleep-overshoot' (how late the frame
+        started compared to when it was due), 'ticks' the number of ticks
+        run and 'dropped' the number of ticks dropped.
+    :dropped: The number of ticks dropped because of the max_ticks cap.
+    """
+
+    def __init__(self, tick_rate=60, target_fps=60, max_ticks=5):
+        self.tick_rate = tick_rate
+        self.tick_time = 1 / tick_rate
+        self.target_fps = target_fps
+        self.max_ticks = max_ticks
+        self.accumulator = 0.0
+        self.alpha = 0.0
+        self.due = None
+        self.dropped = 0
+        self.timings = {'update': 0.0, 'draw': 0.0, 'present': 0.0,
+                        'frame': 0.0, 'interval': 0.0,
+                        'sleep-overshoot': 0.0, 'ticks': 0,
+                        'dropped': 0}
+        self._last = None
+        self._mark = None
+        self._end = None
+
+    def begin_frame(self):
+        """
+        Starts a frame.
+
+        :return: The number of ticks to run on this frame.
+        """
+        now = time.perf_counter()
+        if self._last is None:
+            # The first frame runs a single tick
+            self._last = now - self.tick_time
+            self.due = now
+        self.timings['sleep-overshoot'] = 1e3 * max(0.0, now - self.due)
+        self.accumulator += now - self._last
+        self._last = self._mark = now
+        ticks = int(self.accumulator / self.tick_time)
+        dropped = max(0, ticks - self.max_ticks)
+        if dropped:
+            ticks = self.max_ticks
+            self.accumulator = ticks * self.tick_time
+            self.dropped += dropped
+        self.timings['dropped'] = dropped
+        self.accumulator -= ticks * self.tick_time
+        self.alpha = self.accumulator / self.tick_time
+        self.timings['ticks'] = ticks
+        return ticks
+
+    def lap(self, name):
+        """
+        Records the time elapsed since the previous lap (or the beginning of
+        the frame) in timings.
+
+        :param name: The name of the phase that just ended ('update', 'draw'
+            or 'present').
+        """
+        now = time.perf_counter()
+        self.timings[name] = 1e3 * (now - self._mark)
+        self._mark = now
+
+    def end_frame(self):
+        """
+        Ends a frame, and computes when the next one is due.
+
+        :return: The time (from time.perf_counter) the next frame is due.
+        """
+        now = time.perf_counter()
+        self.timings['frame'] = 1e3 * (now - self._last)
+        if self._end is not None:
+            self.timings['interval'] = 1e3 * (now - self._end)
+        self._end = now
+        if self.target_fps is None:
+            self.due = now
+        else:
+            # Keep a steady pace, but do not try to catch up with late frames
+            self.due = max(self.due + 1 / self.target_fps, now)
+        return self.due
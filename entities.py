@@ -1,5 +1,5 @@
-import pygame
-import numpy
+import sprites as sprite_cache
+from render import ENTITY_LAYER
 
 
 class Entity:
@@ -16,10 +16,36 @@ class Entity:
     :current_sprite: The index of the current sprite.
     :sprites: A list of Surface objects that will be used to draw the entity
         on the screen.
+    :handle: The handle of the entity in the grid it was added to, None if
+        it does not belong to any grid.
+
+    Entities and their pooled subclasses have a fixed layout (__slots__), so
+    that crowds of them take less memory. Each of these classes has a reset
+    method, taking the arguments of its constructor, for pools to reuse
+    released entities (see pool.EntityPool).
     """
 
+    __slots__ = ('_grid', 'handle', '_pool', '_pos', 'map_pos', 'sprite_size',
+                 'sprites_speed', 'current_sprite', 'sprites', 'alive')
+
     def __init__(self, sprite_size=(32, 32), sprite_speed=1, current_sprite=0,
                  pos=(0, 0), map_pos=(0, 0), sprites=None):
+        # Grid the entity was added to and its handle in it, set by
+        # Grid.add_entity, and pool it was acquired from, set by
+        # EntityPool.acquire
+        self._grid = None
+        self.handle = None
+        self._pool = None
+        self._pos = None
+        Entity.reset(self, sprite_size, sprite_speed, current_sprite, pos,
+                     map_pos, sprites)
+
+    def reset(self, sprite_size=(32, 32), sprite_speed=1, current_sprite=0,
+              pos=(0, 0), map_pos=(0, 0), sprites=None):
+        """
+        Resets the entity to the state of a new one built with the same
+        arguments.
+        """
         self.pos = pos
         self.map_pos = map_pos
         self.sprite_size = int(sprite_size[0]), int(sprite_size[1])
@@ -28,31 +54,58 @@ class Entity:
         self.sprites = [] if sprites is None else sprites
         self.alive = True
 
-    def load_sprites(self, sprites_file, nx, ny):
+    def on_release(self):
+        """
+        Called when the entity is released to its pool: drops what it refers
+        to, so that a free entity keeps nothing alive.
+        """
+        self.pos = None
+        self.sprites = []
+
+    def release(self):
+        """
+        Gives the entity back to the pool it was acquired from, once it is
+        done with. Does nothing for entities not acquired from a pool.
+        """
+        if self._pool is not None:
+            self._pool.release(self)
+
+    @property
+    def pos(self):
+        """
+        Pos property getter.
+        """
+        return self._pos
+
+    @pos.setter
+    def pos(self, pos):
+        """
+        Pos property setter. Keeps the spatial index of the grid the entity
+        belongs to up to date.
+        """
+        old_pos = self._pos
+        self._pos = pos
+        if self._grid is not None:
+            self._grid.move_entity(self, old_pos, pos)
+
+    def load_sprites(self, sprites_file, nx, ny, scale=1, atlas=None):
         """
         Load sprites found in files and add them to this objects' sprites.
         Sprites are supposed to be aligned in a grid, and to have the exact
         same size in pixels. They are rescaled to fit this entity's sprite_size.
+        Sprites come from the process-wide sprite cache, so that entities
+        using the same file share the same surfaces.
 
         :param sprites_file: An image file containing sprites
         :param nx: number of sprite in the horizontal direction.
         :param ny: number of sprite in the vertical direction.
+        :param scale: The scale of the frame the entity is drawn on, see
+            Grid.scale.
+        :param atlas: The sprites.SpriteAtlas the sprites are packed into,
+            see Grid.atlas.
         """
-        # Load image from file
-        image = pygame.image.load(sprites_file).convert_alpha()
-        image_width, image_height = image.get_size()
-        # Size of sprites in file
-        size_x = int(image_width / nx)
-        size_y = int(image_height / ny)
-        for y in range(ny):
-            for x in range(nx):
-                # top left corner coordinates, x & y dimension
-                rect = (size_x * x, size_y * y, size_x, size_y)
-                # Rescale the sprite in desired rect box to desired size
-                surf = pygame.transform.smoothscale(
-                    image.subsurface(rect), self.sprite_size)
-                # Add loaded sprite to sprites list
-                self.sprites.append(surf)
+        self.sprites.extend(sprite_cache.load_sprites(
+            sprites_file, nx, ny, self.sprite_size, scale, atlas))
 
     def set_pos(self, grid, position):
         """
@@ -68,14 +121,28 @@ class Entity:
 
     def blit(self, screen, view_coord):
         """
-        Blits the entity on the screen.
+        Blits the entity on the screen. Prefer draw, which batches blits.
 
         :param screen: The pygame surface object representing the screen to
             blit on.
         :param view_coord: The view's coordinates of the grid.
         """
         screen.blit(self.sprites[self.current_sprite],
-                    tuple(numpy.add(self.map_pos, view_coord)))
+                    (self.map_pos[0] + view_coord[0],
+                     self.map_pos[1] + view_coord[1]))
+
+    def draw(self, queue, view_coord, layer=ENTITY_LAYER):
+        """
+        Submits the entity to a render queue, to be drawn with the other
+        queued surfaces.
+
+        :param queue: The render.RenderQueue to submit to.
+        :param view_coord: The view's coordinates of the grid.
+        :param layer: The layer to draw the entity in.
+        """
+        queue.submit(self.sprites[self.current_sprite],
+                     (self.map_pos[0] + view_coord[0],
+                      self.map_pos[1] + view_coord[1]), layer)
 
 
 class Storage(Entity):
@@ -143,31 +210,49 @@ class Movable(Entity):
     :can_move: Flag telling if the entity can move or not.
     """
 
+    __slots__ = ('_direction', '_old_direction', '_can_move', '_posture',
+                 'postures', 'speed', 'def_posture')
+
+    # Postures every movable entity has, not to be modified
+    default_postures = {
+        'still': [
+            [1],
+            [4],
+            [7],
+            [10],
+            ],
+        'walking': [
+            [0, 1, 2, 1],
+            [3, 4, 5, 4],
+            [6, 7, 8, 7],
+            [9, 10, 11, 10],
+            ],
+        }
+
     def __init__(self, direction, posture, speed, sprite_size=(32, 32),
                  sprite_speed=1, current_sprite=0, pos=(0, 0), map_pos=(0, 0),
                  sprites=None):
         Entity.__init__(self, sprite_size, sprite_speed, current_sprite, pos,
                         map_pos, sprites)
+        Movable.reset(self, direction, posture, speed, sprite_size,
+                      sprite_speed, current_sprite, pos, map_pos, sprites)
+
+    def reset(self, direction, posture, speed, sprite_size=(32, 32),
+              sprite_speed=1, current_sprite=0, pos=(0, 0), map_pos=(0, 0),
+              sprites=None):
+        """
+        Resets the entity to the state of a new one built with the same
+        arguments.
+        """
+        Entity.reset(self, sprite_size, sprite_speed, current_sprite, pos,
+                     map_pos, sprites)
         self._direction = direction
         self._old_direction = direction
         self._can_move = False
 
         self._posture = []
-        # Setup of postures
-        self.postures = {
-            'still': [
-                [1],
-                [4],
-                [7],
-                [10],
-                ],
-            'walking': [
-                [0, 1, 2, 1],
-                [3, 4, 5, 4],
-                [6, 7, 8, 7],
-                [9, 10, 11, 10],
-                ],
-            }
+        # Setup of postures, sharing the default ones
+        self.postures = dict(self.default_postures)
         self.speed = speed
         # Initiates posture
         self.posture = self.def_posture = posture
@@ -294,7 +379,7 @@ class Movable(Entity):
             s_x += self.speed
         else:  # _direction == 0 (or invalid case, but shouldn't happen)
             can_move = False
-        can_move = can_move and grid.level.map[y][x] not in ('o',)
+        can_move = can_move and not grid.level.is_blocked(x, y)
         self._can_move = can_move
         # Update posture, now that we now if we move
         if full:
@@ -344,7 +429,7 @@ class Player(Movable, Storage):
         Movable.__init__(self, direction, posture, 2, grid.tilesize, 2)
         # Load sprites
         for file, nx, ny in self.sprites_files[sex]:
-            self.load_sprites(file, nx, ny)
+            self.load_sprites(file, nx, ny, grid.scale, grid.atlas)
         # Put the player in the center of the screen, then computes to which
         # coordinates it correspond in the map.
         # The player position is adjusted so that it is precisely fitting in
@@ -397,9 +482,8 @@ class Player(Movable, Storage):
         # Calling parent's update function
         Movable.update(self, direction, grid, full)
         # looking for money on the same tile
-        for _, entity in grid.entities.items():
-            if entity.pos == self.pos and isinstance(entity, Coin):
-                entity.collect(self)
+        for coin in grid.entities_at(self.pos, Coin):
+            coin.collect(self)
 
     def get_speed(self):
         return 2 * (1 + int(self.running))  # Running: True -> 4, False -> 2
@@ -413,6 +497,70 @@ class Player(Movable, Storage):
             self.posture = 'still'
 
 
+class Walker(Movable):
+    """
+    A Movable entity walking on its own towards a goal, finding its way with
+    the pathfinding service of the grid. It can be added to the grid like any
+    other entity.
+
+    :goal: The (x, y) tile the walker heads to, or an entity it follows,
+        None to stand still.
+    :shared: True if the goal is shared by many walkers (such as the player
+        chased by many monsters): the way is then found with the flow field
+        of the goal, computed once for all of them. False to find the way
+        with A*.
+
+    A walker with nowhere to go sleeps for nap ticks before looking for its
+    way again, unless something wakes it up before.
+    """
+
+    __slots__ = ('goal', 'shared')
+
+    nap = 16
+
+    def __init__(self, speed, sprite_size=(32, 32), goal=None, shared=True,
+                 direction=1, posture='still', sprite_speed=1):
+        Movable.__init__(self, direction, posture, speed, sprite_size,
+                         sprite_speed)
+        self.goal = goal
+        self.shared = shared
+
+    def reset(self, speed, sprite_size=(32, 32), goal=None, shared=True,
+              direction=1, posture='still', sprite_speed=1):
+        """
+        Resets the walker to the state of a new one built with the same
+        arguments.
+        """
+        Movable.reset(self, direction, posture, speed, sprite_size,
+                      sprite_speed)
+        self.goal = goal
+        self.shared = shared
+
+    def on_release(self):
+        Movable.on_release(self)
+        self.goal = None
+
+    def update(self, grid, full=True):
+        """
+        Updates the walker, taking the direction towards its goal.
+
+        :param grid: The grid this walker belongs to.
+        :param full: As in Movable.update.
+        """
+        goal = self.goal
+        if isinstance(goal, Entity):
+            goal = goal.pos
+        if goal is None or self.pos is None:
+            direction = 0
+        else:
+            direction = grid.paths.direction(self.pos, goal, self.shared)
+        Movable.update(self, direction, grid, full)
+        if direction == 0 and \
+                self.map_pos[0] % grid.tilesize[0] == 0 and \
+                self.map_pos[1] % grid.tilesize[1] == 0:
+            grid.sleep(self, self.nap)
+
+
 class Coin(Entity):
     """
     A collectible coin that will go into player's balance.
@@ -420,33 +568,47 @@ class Coin(Entity):
     :value: The value of the coin, added to player's balance when collected.
     """
 
+    __slots__ = ('value', '_jump_counter', '_frame_counter')
+
     def __init__(self, sprite_size, value):
         Entity.__init__(self, sprite_size, 1, 0)
+        Coin.reset(self, sprite_size, value)
+
+    def reset(self, sprite_size, value):
+        """
+        Resets the coin to the state of a new one built with the same
+        arguments.
+        """
+        Entity.reset(self, sprite_size, 1, 0)
         self.value = value
         self._jump_counter = None
         self._frame_counter = 0
-        self.sprites_speed = 1
 
     def update(self, grid):
         """
-        Updates the coin on every frame. Animates it when collected,
-        then kills itself.
+        Updates the coin, on the ticks it is scheduled on. An idle coin goes
+        to sleep on its first update, until it is collected. A collected
+        coin is then updated on every tick: it jumps, then kills itself,
+        going back to its pool if it was acquired from one.
 
         :param grid: The grid this coin belongs to.
         """
         cnt = self._jump_counter
+        if cnt is None:
+            grid.sleep(self)
+            return
         if self._frame_counter <= 0:
             self._frame_counter = self.sprites_speed
         else:
             self._frame_counter -= 1
             return
-        if cnt is not None:
-            if cnt < 6:
-                self.map_pos = self.map_pos[0], self.map_pos[1] + cnt
-                self._jump_counter += 1
-            else:
-                self._jump_counter = None
-                grid.remove_entity(self)
+        if cnt < 6:
+            self.map_pos = self.map_pos[0], self.map_pos[1] + cnt
+            self._jump_counter += 1
+        else:
+            self._jump_counter = None
+            grid.remove_entity(self)
+            self.release()
 
     def collect(self, collector):
         """
@@ -462,6 +624,8 @@ class Coin(Entity):
             self._jump_counter = -6
             self.pos = None
             self.alive = False
+            if self._grid is not None:
+                self._grid.wake(self)
             return True
         except AttributeError:
             return False
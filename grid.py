@@ -1,8 +1,56 @@
-from Level import Level
+import numpy
+import pygame
+
+from Level import Level, STATIC_LAYERS, tile_cache
+from animation import AnimatedCells, TileAnimation, draw_cells
+from chunks import ChunkedBackground
+from levels import LevelCache
+from pathfinding import Pathfinding
+from profiling import profiler
+from scheduler import Scheduler
+
+# Number of bits of an entity handle used for the slot index, the remaining
+# high bits hold the slot generation.
+HANDLE_SLOT_BITS = 32
+HANDLE_SLOT_MASK = (1 << HANDLE_SLOT_BITS) - 1
 
 
 class Grid:
-    def __init__(self, levelmap, screen, grid_dim, view_coord):
+    """
+    The map, as a grid of tiles, and the entities on it.
+
+    When chunk_size is given, the background is a ChunkedBackground streamed
+    chunk by chunk around the view, instead of a single surface covering the
+    whole map. chunk_memory is then the memory budget of its chunks, in
+    bytes.
+
+    The background holds the ground and decoration layers of the map. The
+    overhead layer, if any, is prerendered the same way, transparent, to be
+    drawn over the entities (see overhead_blits). Animated tiles are
+    redrawn on them as they change (see animate).
+
+    Levels are kept in a LevelCache of level_memory bytes, and the levels
+    exits lead to are prefetched when getting close to them (see
+    prefetch_exits), so that changing level is immediate.
+
+    paths is the Pathfinding service of the current level.
+
+    The map is drawn scale times smaller than the screen, on the low
+    resolution frame of a render.FrameScaler, while positions (view_coord,
+    tilesize, map_pos of the entities) stay in screen pixels. A scale of
+    None draws the tiles at the native resolution of the tileset of the
+    first level loaded.
+
+    atlas is the sprites.SpriteAtlas the sprites of the entities are packed
+    into, None to keep each sprite in its own surface.
+
+    scheduler decides which entities are updated on each tick: entities
+    with nothing to do go to sleep (see sleep) until an event wakes them up.
+    """
+
+    def __init__(self, levelmap, screen, grid_dim, view_coord,
+                 chunk_size=None, chunk_memory=64 * 2**20,
+                 level_memory=64 * 2**20, scale=1, atlas=None):
         self.screen_pos = view_coord
         self.screen = screen  # pygame display
         # tuple, grid dimensions (horizontal tiles, vertical tiles)
@@ -11,26 +59,515 @@ class Grid:
         self.view_coord = view_coord
         self.tilesize = int(screen.get_rect().width / grid_dim[0]), \
             int(screen.get_rect().height / grid_dim[1])
-        self.level = Level(levelmap)
-        self.background = self.level.render(self.screen, self.size)
+        # Set by the first load_level if None
+        self.scale = None
+        # Size of the tiles on the frame the map is drawn on
+        self.render_tilesize = None
+        if scale is not None:
+            self.use_scale(scale)
+        self.atlas = atlas
+        # Scaled tiles cache, shared by all the levels of the grid
+        self.tile_cache = tile_cache
+        self.chunk_size = chunk_size
+        self.chunk_memory = chunk_memory
+        self.levels = LevelCache(self.load_level, level_memory)
+        self.setLevel(levelmap)
+        # Entity handle -> entity. A handle packs the slot of the entity and
+        # the generation of this slot, so that stale handles are detected
+        # once the slot is reused.
         self.entities = dict()
+        self._generations = []
+        self._free_slots = []
+        self.scheduler = Scheduler()
+        # Struct-of-arrays entity stores, see store.EntityStore
+        self.stores = []
+        # Spatial index, tile -> set of the entities standing on this tile.
+        # Entities that are not on any tile (pos is None) are under None.
+        self._tiles = dict()
+
+    def use_scale(self, scale):
+        """
+        Sets the scale the map is drawn at. Levels are rendered at this
+        scale, it must thus be set before the first one is loaded.
+        """
+        self.scale = scale
+        self.render_tilesize = self.tilesize[0] // scale, \
+            self.tilesize[1] // scale
 
     def setLevel(self, levelmap):
-        self.level = Level(levelmap)
-        self.background = self.level.render(self.screen, self.size)
+        """
+        Switches to a level, taken from the level cache if it was loaded
+        before or prefetched.
+
+        :param levelmap: The path of the map file of the level.
+        """
+        self.level, (self.background, self.overhead) = \
+            self.levels.get(levelmap)
+        # Tiles of prefetched levels were only decoded on the worker thread
+        self.level.convert_tiles(self.tile_cache)
+        # Structures derived from the level, built on the first switch to it
+        # and kept with it in the level cache
+        state = self.levels.state(levelmap)
+        if not state:
+            state.update(self.derive_state(self.level, self.background,
+                                           self.overhead))
+        self.animation = state['animation']
+        self._animated = state['animated']
+        self.paths = state['paths']
+        self.exits = state['exits']
+        self._exit_tiles = state['exit_tiles']
+        self._prefetch_pos = None
+
+    def derive_state(self, level, background, overhead):
+        """
+        Builds the structures derived from a level: the animation of its
+        tiles, its pathfinding and its exits.
+
+        :param background: The background of the level, as from load_level.
+        :param overhead: The overhead layer of the level, as from load_level.
+
+        :return: A dictionary of these structures, by name.
+        """
+        state = {'animation': None, 'paths': Pathfinding(level)}
+        # Animated cells of the prerendered surfaces, chunked backgrounds
+        # animate their own chunks
+        state['animated'] = animated = []
+        if self.chunk_size is None:
+            animation = state['animation'] = TileAnimation(
+                level, self.tile_cache, self.render_tilesize)
+            for layers, surface in ((STATIC_LAYERS, background),
+                                    (('overhead',), overhead)):
+                if surface is not None:
+                    animated.append((AnimatedCells(level, animation, layers),
+                                     surface))
+        # Exits of the level, tile -> (map file, arrival tile), and the
+        # tiles of the exits leading to each map file
+        state['exits'] = exits = {}
+        exit_tiles = {}
+        for x, y, filename, arrival in level.exits():
+            exits[(x, y)] = filename, arrival
+            exit_tiles.setdefault(filename, []).append((x, y))
+        state['exit_tiles'] = {filename: numpy.array(tiles)
+                               for filename, tiles in exit_tiles.items()}
+        return state
+
+    def load_level(self, levelmap):
+        """
+        Loads a level and renders its background, and its overhead layer.
+        May be called from the worker thread of the level cache.
+
+        :param levelmap: The path of the map file of the level.
+        :return: The (level, (background, overhead)) tuple, overhead being
+            None if the level has no overhead layer.
+        """
+        with profiler.scope('level.load'):
+            level = Level(levelmap)
+        if self.scale is None:
+            self.use_scale(max(1, self.tilesize[0] // level.tile_width))
+        backgrounds = []
+        for layers in (STATIC_LAYERS, ('overhead',)):
+            if layers[0] != 'map' and level.layer(layers[0]) is None:
+                backgrounds.append(None)
+            elif self.chunk_size is None:
+                with profiler.scope('level.render'):
+                    backgrounds.append(level.render(
+                        self.screen, self.size, self.tile_cache,
+                        scale=self.scale, layers=layers))
+            else:
+                backgrounds.append(ChunkedBackground(
+                    level, self.render_tilesize, self.tile_cache,
+                    self.chunk_size, self.chunk_memory, layers=layers))
+        return level, tuple(backgrounds)
+
+    def set_tile(self, x, y, char, layer='map'):
+        """
+        Changes a tile of the level, and updates the background. Paths and
+        flow fields follow the change.
+
+        :param char: The key char of the new tile.
+        :param layer: The layer of the tile, one of the layers of the level.
+        """
+        self.level.set_tile(x, y, char, layer)
+        background = self.overhead if layer == 'overhead' else self.background
+        if self.chunk_size is not None:
+            background.invalidate(x, y)
+            return
+        self.animation.add_tiles()
+        for cells, surface in self._animated:
+            if surface is background:
+                draw_cells(surface, self.animation, cells.arrays(), [(x, y)])
+
+    def animate(self, tick):
+        """
+        Moves the animated tiles to a tick, and redraws the visible animated
+        cells of the background and overhead layer that show another frame.
+        Should be called once per frame, before drawing.
+
+        :param tick: The current tick.
+        :return: The list of the pygame.Rect of the frame that were redrawn.
+        """
+        view = self.frame_view()
+        if self.chunk_size is not None:
+            rects = self.background.animate(tick, view, self.frame_size())
+            if self.overhead is not None:
+                rects.extend(self.overhead.animate(tick, view,
+                                                   self.frame_size()))
+            return rects
+        self.animation.update(tick)
+        area = self.visible_area()
+        rects = []
+        for cells, surface in self._animated:
+            rects.extend(rect.move(view) for rect in
+                         cells.refresh(surface, cells.block_range(area)))
+        return rects
+
+    def overhead_blits(self):
+        """
+        :return: The list of the (surface, screen position, area) blits of
+            the visible part of the overhead layer, to draw over the
+            entities. Empty if the level has no overhead layer.
+        """
+        if self.overhead is None:
+            return []
+        view = self.frame_view()
+        if self.chunk_size is not None:
+            return [(surface, position, None) for surface, position
+                    in self.overhead.blits(view, self.frame_size())]
+        area = self.visible_area()
+        return [(self.overhead, (area.x + view[0], area.y + view[1]), area)]
+
+    def exit_at(self, tile):
+        """
+        :param tile: The (x, y) coordinates of a tile.
+        :return: The (map file, arrival tile) of the exit on the tile, None
+            if there is none. The arrival tile is None when not specified.
+        """
+        return self.exits.get(tile)
+
+    def prefetch_exits(self, tile, radius=8):
+        """
+        Prefetches the levels of the exits close to a tile, usually the
+        player's, and collects the prefetched levels. Should be called once
+        per frame.
+
+        :param tile: The (x, y) coordinates of the tile.
+        :param radius: The distance, in tiles, from which exits are close.
+        """
+        self.levels.collect()
+        if tile == self._prefetch_pos or tile is None:
+            return
+        self._prefetch_pos = tile
+        for filename, tiles in self._exit_tiles.items():
+            if (abs(tiles - tile).max(1) <= radius).any():
+                self.levels.prefetch(filename)
+
+    def clear_entities(self):
+        """
+        Removes every entity of the grid and of its stores. Entities
+        acquired from a pool go back to it.
+        """
+        entities = list(self.entities.values())
+        self.despawn(entities)
+        for entity in entities:
+            entity.release()
+        for store in self.stores:
+            store.remove(numpy.flatnonzero(store.used))
+
+    def draw_background(self, screen):
+        """
+        Draws the visible part of the map on the screen.
+
+        :param screen: The surface to draw on, the frame when the map is
+            scaled down.
+        """
+        view = self.frame_view()
+        if self.chunk_size is not None:
+            self.background.draw(screen, view)
+            return
+        area = self.visible_area()
+        screen.blit(self.background, (area.x + view[0], area.y + view[1]),
+                    area)
+
+    def stream(self, direction):
+        """
+        Prefetches the background chunks the view is moving towards, when
+        the background is chunked. Should be called once per frame.
+
+        :param direction: The direction the view moves to, 1: UP, 2: DOWN,
+            3: LEFT, 4: RIGHT, 0 for none.
+        """
+        if self.chunk_size is not None:
+            self.background.prefetch(self.frame_view(), self.frame_size(),
+                                     direction)
+
+    def visible_rect(self, margin=1):
+        """
+        :param margin: The number of tiles to add around the screen, so that
+            entities moving between two tiles are not missed.
+        :return: The (x, y, width, height) rectangle, in tiles, of the part of
+            the map visible on the screen for current view_coord.
+        """
+        sc_width, sc_height = self.screen.get_size()
+        x0 = -self.view_coord[0] // self.tilesize[0] - margin
+        y0 = -self.view_coord[1] // self.tilesize[1] - margin
+        x1 = -((self.view_coord[0] - sc_width) // self.tilesize[0]) + margin
+        y1 = -((self.view_coord[1] - sc_height) // self.tilesize[1]) + margin
+        return x0, y0, x1 - x0, y1 - y0
+
+    def visible_area(self):
+        """
+        :return: The pygame.Rect of the part of the background visible on the
+            screen for current view_coord, in background pixels.
+        """
+        x, y = self.frame_view()
+        area = pygame.Rect((-x, -y), self.frame_size())
+        return area.clip(self.background.get_rect())
+
+    def frame_view(self):
+        """
+        :return: view_coord, in pixels of the frame the map is drawn on.
+        """
+        return self.view_coord[0] // self.scale, \
+            self.view_coord[1] // self.scale
+
+    def frame_size(self):
+        """
+        :return: The size of the frame the map is drawn on, in pixels.
+        """
+        width, height = self.screen.get_size()
+        return width // self.scale, height // self.scale
+
+    def visible_entities(self):
+        """
+        :return: A list of the entities that may be visible on the screen:
+            the entities in visible_rect, and the ones not on any tile whose
+            map_pos is in it.
+        """
+        rect = self.visible_rect()
+        found = self.entities_in_rect(rect)
+        untiled = self._tiles.get(None)
+        if untiled:
+            x, y, w, h = rect
+            tw, th = self.tilesize
+            view = pygame.Rect(x * tw, y * th, w * tw, h * th)
+            found.extend(entity for entity in untiled
+                         if view.collidepoint(entity.map_pos))
+        return found
 
     def get_mod(self):
         return self.view_coord[0] % self.tilesize[0], \
                self.view_coord[1] % self.tilesize[1]
 
     def add_entity(self, entity):
-        for i in range(len(self.entities) + 1):
-            if i not in self.entities:
-                self.entities[i] = entity
-                return i
+        """
+        Adds an entity to the grid.
+
+        :param entity: The entity to add.
+        :return: The handle of the entity, also stored in entity.handle.
+        """
+        if self._free_slots:
+            slot = self._free_slots.pop()
+        else:
+            slot = len(self._generations)
+            self._generations.append(0)
+        handle = self._generations[slot] << HANDLE_SLOT_BITS | slot
+        self.entities[handle] = entity
+        entity.handle = handle
+        entity._grid = self
+        self._index(entity, entity.pos)
+        self.scheduler.add(entity)
+        return handle
 
     def remove_entity(self, entity):
-        for i in self.entities:
-            if entity is self.entities[i]:
-                del self.entities[i]
-                return i
+        """
+        Removes an entity from the grid.
+
+        :param entity: The entity to remove.
+        :return: The handle the entity had, None if it was not in the grid.
+        """
+        handle = entity.handle
+        if handle is None or self.entities.get(handle) is not entity:
+            return None
+        del self.entities[handle]
+        slot = handle & HANDLE_SLOT_MASK
+        # Bumping the generation invalidates every copy of the handle
+        self._generations[slot] += 1
+        self._free_slots.append(slot)
+        self._unindex(entity, entity.pos)
+        self.scheduler.remove(entity)
+        entity.handle = None
+        entity._grid = None
+        return handle
+
+    def spawn(self, entities):
+        """
+        Adds several entities to the grid at once.
+
+        :param entities: An iterable of entities.
+        :return: The list of the handles of the entities.
+        """
+        return [self.add_entity(entity) for entity in entities]
+
+    def despawn(self, entities):
+        """
+        Removes several entities from the grid at once.
+
+        :param entities: An iterable of entities.
+        :return: The number of entities actually removed.
+        """
+        return sum(self.remove_entity(entity) is not None
+                   for entity in entities)
+
+    def get_entity(self, handle):
+        """
+        :param handle: An entity handle, as returned by add_entity.
+        :return: The entity of the handle, None if the handle is stale.
+        """
+        return self.entities.get(handle)
+
+    def is_valid(self, handle):
+        """
+        :param handle: An entity handle, as returned by add_entity.
+        :return: True if the handle still refers to an entity of the grid.
+        """
+        return handle in self.entities
+
+    def due_entities(self):
+        """
+        Starts a new tick of the scheduler.
+
+        :return: The list of the entities to update on this tick.
+        """
+        return self.scheduler.due()
+
+    def sleep(self, entity, ticks=None):
+        """
+        Stops updating an entity of the grid until it is woken up, by wake,
+        wake_near or after the given number of ticks.
+
+        :param ticks: The number of ticks after which the entity wakes up,
+            None to sleep until woken up.
+        """
+        self.scheduler.sleep(entity, ticks)
+
+    def wake(self, entity):
+        """
+        Updates a sleeping entity of the grid again.
+        """
+        self.scheduler.wake(entity)
+
+    def wake_near(self, tile, radius):
+        """
+        Wakes up the sleeping entities close to a tile, such as the player's
+        when it moves.
+
+        :param tile: The (x, y) coordinates of the tile.
+        :param radius: The distance, in tiles, from which entities are close.
+        """
+        if tile is None:
+            return
+        size = 2 * radius + 1
+        rect = tile[0] - radius, tile[1] - radius, size, size
+        scheduler = self.scheduler
+        for entity in self.entities_in_rect(rect):
+            if scheduler.is_sleeping(entity):
+                scheduler.wake(entity)
+
+    def set_update_period(self, entity, period):
+        """
+        Updates an entity of the grid only every period ticks, such as every
+        4 ticks for a distant NPC.
+        """
+        self.scheduler.set_period(entity, period)
+
+    def add_store(self, store):
+        """
+        Adds an EntityStore to the grid. The entities of the store are then
+        returned by the lookups of the grid (entities_at, entities_in_rect
+        and visible_entities).
+
+        :param store: The EntityStore to add.
+        """
+        self.stores.append(store)
+
+    def update_stores(self):
+        """
+        Updates all the entities of the stores of the grid by one tick.
+        """
+        for store in self.stores:
+            store.update()
+
+    def move_entity(self, entity, old_pos, new_pos):
+        """
+        Keeps the spatial index up to date when an entity changes tile. This
+        is called by the entities themselves whenever their pos is modified.
+
+        :param entity: The entity that moved.
+        :param old_pos: The previous tile of the entity (None if it had none).
+        :param new_pos: The new tile of the entity (None if it has none).
+        """
+        if old_pos != new_pos:
+            self._unindex(entity, old_pos)
+            self._index(entity, new_pos)
+
+    def entities_at(self, tile, kind=None):
+        """
+        :param tile: A 2-tuple of integers, the tile to look at (None for
+            the entities that are not on any tile).
+        :param kind: If given, only entities that are instances of this class
+            (or tuple of classes) are returned.
+        :return: A list of the entities standing on the given tile.
+        """
+        found = []
+        entities = self._tiles.get(tile)
+        if entities:
+            if kind is None:
+                found.extend(entities)
+            else:
+                found.extend(entity for entity in entities
+                             if isinstance(entity, kind))
+        for store in self.stores:
+            found.extend(store.entities_at(tile, kind))
+        return found
+
+    def entities_in_rect(self, rect, kind=None):
+        """
+        :param rect: A (x, y, width, height) rectangle in tiles (a pygame.Rect
+            works too).
+        :param kind: If given, only entities that are instances of this class
+            (or tuple of classes) are returned.
+        :return: A list of the entities standing in the given rectangle.
+        """
+        x, y, w, h = rect
+        found = []
+        if w * h <= len(self._tiles):
+            # Small rectangle, look up each tile of the rectangle
+            tiles = ((i, j) for i in range(x, x + w) for j in range(y, y + h))
+            groups = (self._tiles.get(tile) for tile in tiles)
+        else:
+            # Sparse map, look up each occupied tile instead
+            groups = (entities for tile, entities in self._tiles.items()
+                      if tile is not None and x <= tile[0] < x + w
+                      and y <= tile[1] < y + h)
+        for entities in groups:
+            if entities:
+                found.extend(entities)
+        if kind is not None:
+            found = [entity for entity in found if isinstance(entity, kind)]
+        for store in self.stores:
+            found.extend(store.entities_in_rect(rect, kind))
+        return found
+
+    def _index(self, entity, tile):
+        entities = self._tiles.get(tile)
+        if entities is None:
+            self._tiles[tile] = {entity}
+        else:
+            entities.add(entity)
+
+    def _unindex(self, entity, tile):
+        entities = self._tiles.get(tile)
+        if entities is not None:
+            entities.discard(entity)
+            if not entities:
+                del self._tiles[tile]
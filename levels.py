@@ -0,0 +1,164 @@
+import concurrent.futures
+import os
+from collections import OrderedDict
+
+import pygame
+
+from chunks import ChunkedBackground
+
+
+def level_size(level, background):
+    """
+    :param background: The background of the level, or a tuple of its
+        backgrounds (such as its background and overhead layer).
+    :return: An estimate of the memory used by a level and its background,
+        in bytes. The chunks of a ChunkedBackground are counted as rendered
+        so far.
+    """
+    size = level.indices.nbytes + level.blocked.nbytes
+    size += sum(layer.nbytes for layer in level.layers.values())
+    backgrounds = background if isinstance(background, tuple) \
+        else (background,)
+    for background in backgrounds:
+        if isinstance(background, pygame.Surface):
+            size += background.get_pitch() * background.get_height()
+        elif isinstance(background, ChunkedBackground):
+            size += background.memory
+    return size
+
+
+class LevelCache:
+    """
+    A cache of loaded levels, with their background, so that switching to a
+    recently used level is immediate. The cache is a LRU bounded by a memory
+    budget.
+
+    Levels can also be prefetched: they are then loaded on a worker thread
+    while the game goes on, typically when the player gets close to an exit
+    leading to them, so that they are ready when actually needed.
+
+    Each cached level comes with a state dictionary (see state), where the
+    user of the cache keeps the structures it derives from the level, so
+    that they are built once per load, not on every switch to the level.
+
+    :load: The function loading a level, from the path of its map file to a
+        (level, background) tuple. It is called from the worker thread for
+        prefetched levels.
+    :memory_budget: The maximal number of bytes of the cached levels. The
+        level in use is always kept, even over budget.
+    :memory: The estimated number of bytes of the cached levels. As the
+        chunks of chunked backgrounds are rendered while their level is in
+        use, sizes are measured again whenever the level in use changes.
+    :hits: The number of levels found in the cache, or being prefetched.
+    :misses: The number of levels loaded synchronously.
+    """
+
+    def __init__(self, load, memory_budget=64 * 2**20):
+        self.load = load
+        self.memory_budget = memory_budget
+        self.memory = 0
+        self.hits = 0
+        self.misses = 0
+        # Map path -> (level, background, size, state), least recently used
+        # first
+        self._levels = OrderedDict()
+        # Map path -> Future of the (level, background) being prefetched
+        self._pending = {}
+        self._current = None
+        self._executor = None
+
+    @staticmethod
+    def key(filename):
+        return os.path.normpath(filename)
+
+    def get(self, filename):
+        """
+        :param filename: The path of the map file of the level.
+        :return: The (level, background) of the level, loaded now if it was
+            neither cached nor prefetched, waiting for it if it is still
+            being prefetched. It becomes the level in use.
+        """
+        key = self.key(filename)
+        self._current = key
+        cached = self._levels.get(key)
+        if cached is not None:
+            self._levels.move_to_end(key)
+            self.hits += 1
+            self._evict(key)
+            return cached[:2]
+        future = self._pending.pop(key, None)
+        if future is not None:
+            self.hits += 1
+            level, background = future.result()
+        else:
+            self.misses += 1
+            level, background = self.load(filename)
+        self._store(key, level, background)
+        return level, background
+
+    def prefetch(self, filename):
+        """
+        Starts loading a level on the worker thread, if it is neither cached
+        nor already being loaded.
+
+        :param filename: The path of the map file of the level.
+        """
+        key = self.key(filename)
+        if key in self._levels or key in self._pending:
+            return
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                1, thread_name_prefix='levels')
+        self._pending[key] = self._executor.submit(self.load, filename)
+
+    def collect(self):
+        """
+        Moves the levels that finished prefetching into the cache. Levels
+        that failed to load are dropped: the error is raised again if they
+        are actually needed.
+        """
+        for key, future in list(self._pending.items()):
+            if future.done():
+                del self._pending[key]
+                if future.exception() is None:
+                    self._store(key, *future.result())
+
+    def _store(self, key, level, background):
+        self._levels.pop(key, None)
+        self._levels[key] = level, background, 0, {}
+        self._evict(key)
+
+    def _evict(self, key):
+        # Sizes are measured again, as chunked backgrounds grow, then least
+        # recently used levels are evicted, but never the level in use nor
+        # the given one
+        self.memory = 0
+        for old, (level, background, _, state) in list(self._levels.items()):
+            size = level_size(level, background)
+            self._levels[old] = level, background, size, state
+            self.memory += size
+        for old in list(self._levels):
+            if self.memory <= self.memory_budget:
+                break
+            if old == self._current or old == key:
+                continue
+            self.memory -= self._levels.pop(old)[2]
+
+    def state(self, filename):
+        """
+        :param filename: The path of the map file of the level.
+        :return: The state dictionary of a cached level, dropped with it, None
+            if the level is not cached.
+        """
+        cached = self._levels.get(self.key(filename))
+        return None if cached is None else cached[3]
+
+    def __contains__(self, filename):
+        return self.key(filename) in self._levels
+
+    def clear(self):
+        """
+        Drops every cached level.
+        """
+        self._levels.clear()
+        self.memory = 0
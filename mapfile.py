@@ -0,0 +1,307 @@
+import numpy
+
+# Layers of tiles of a map, drawn in this order: the ground ('map'), then
+# decoration, both on the background, then overhead, drawn over entities
+LAYERS = ('map', 'decoration', 'overhead')
+# Chars of the empty cells of the layers other than the ground. Spaces are
+# only empty cells inside rows, see parse_map
+EMPTY_CELLS = ' -'
+# Number of cells translated at once, see parse_map
+TRANSLATE_BLOCK = 1 << 16
+
+
+class MapError(ValueError):
+    """
+    An error in a .map file.
+
+    :filename: The path of the map file.
+    :line: The number of the line of the error, starting at 1, None if it is
+        not about a line.
+    """
+
+    def __init__(self, filename, line, message):
+        if line is None:
+            ValueError.__init__(self, '%s: %s' % (filename, message))
+        else:
+            ValueError.__init__(self, '%s:%d: %s' % (filename, line, message))
+        self.filename = filename
+        self.line = line
+
+
+class TileKey:
+    """
+    The typed attributes of a key of a map.
+
+    :char: The char of the key in the rows of the map.
+    :frames: The list of the (tx, ty) positions in the tileset of the frames
+        of its tile, a single one for static tiles.
+    :period: The number of ticks each frame is shown, 0 for static tiles.
+    :block: True if the tile can not be walked on.
+    :exit: The path of the map file the tile leads to, relative to the map,
+        None if it is not an exit.
+    :arrival: The (x, y) tile to arrive on through the exit, None if not
+        given.
+    :attributes: The dictionary of the raw attributes of the key, as strings.
+    """
+
+    def __init__(self, char, attributes, filename=None, lines=None):
+        """
+        :param attributes: The dictionary of the raw attributes.
+        :param filename: The path of the map file, for errors.
+        :param lines: A dictionary attribute -> number of its line, for
+            errors.
+        """
+        lines = lines or {}
+
+        def error(name, message):
+            return MapError(filename, lines.get(name),
+                            'key [%s]: %s' % (char, message))
+
+        def ints(name, value, count):
+            try:
+                values = tuple(int(i) for i in value.split(','))
+            except ValueError:
+                values = ()
+            if len(values) != count:
+                expected = 'an integer' if count == 1 else \
+                    "%d integers separated by ','" % count
+                raise error(name, '%s must be %s, not %r'
+                            % (name, expected, value))
+            return values
+
+        self.char = char
+        self.attributes = attributes
+        if 'tile' not in attributes:
+            raise error(None, 'no tile')
+        self.frames = []
+        for frame in attributes['tile'].split():
+            ty, tx = ints('tile', frame, 2)
+            self.frames.append((tx, ty))
+        if not self.frames:
+            raise error('tile', 'no tile')
+        self.period = 0
+        if len(self.frames) > 1:
+            if 'period' not in attributes:
+                raise error('tile', 'animated tile without period')
+            self.period, = ints('period', attributes['period'], 1)
+            if self.period <= 0:
+                raise error('period', 'period must be positive')
+        self.block = ints('block', attributes.get('block', '0'), 1)[0] != 0
+        self.exit = attributes.get('exit')
+        self.arrival = None
+        if 'arrival' in attributes:
+            self.arrival = ints('arrival', attributes['arrival'], 2)
+
+
+class MapData:
+    """
+    The content of a .map file, see parse_map.
+
+    :tileset: The path of the tileset image.
+    :tile_width: The width of the tiles in the tileset, in pixels.
+    :tile_height: The height of the tiles in the tileset, in pixels.
+    :width: The width of the map, in tiles.
+    :height: The height of the map, in tiles.
+    :chars: A string of the distinct chars of the rows of the map.
+    :indices: The (height, width) uint8 array of the index in chars of the
+        char of each cell of the ground.
+    :layers: A dictionary name -> indices of the other layers of the map.
+    :key: A dictionary char -> dictionary of the raw attributes of its key.
+    :key_table: A dictionary char -> TileKey of its key.
+    """
+
+    def __init__(self):
+        self.tileset = None
+        self.tile_width = self.tile_height = None
+        self.width = self.height = None
+        self.chars = ''
+        self.indices = None
+        self.layers = {}
+        self.key = {}
+        self.key_table = {}
+
+
+class _Layer:
+    # Rows of a layer, streamed into a bytearray of char codes
+
+    def __init__(self, line):
+        self.line = line
+        self.width = None
+        self.cells = bytearray()
+        # Line number of each row
+        self.lines = []
+
+
+def parse_map(filename):
+    """
+    Parses a .map file, streaming its rows line by line into arrays of tile
+    indices: memory is about a byte per cell and layer, whatever the size
+    of the map.
+
+    A .map file is made of sections, a [level] section then a section per
+    key char. Options are 'name = value' or 'name: value' lines, values may
+    go on on indented lines. Lines starting with '#' or ';' are comments.
+    The [level] section gives the tileset, the width and height of its
+    tiles, and the rows of the layers of the map (see LAYERS), one per
+    line, indentation being ignored. Each key section gives the attributes
+    of its char, see TileKey. Rows must all have the same width, and the
+    chars of the ground must have a key, as the ones of the other layers,
+    except the empty cells (see EMPTY_CELLS).
+
+    Whitespace around rows is stripped, whatever the layer and the
+    indentation, so empty cells at the start or the end of a row must be
+    '-'. Spaces inside rows are empty cells.
+
+    :param filename: The path of the map file.
+    :return: The MapData of the file.
+    :raise MapError: If the file is not a valid map, with the line of the
+        error.
+    """
+    level = {}
+    level_lines = {}
+    layers = {}
+    keys = {}
+    key_lines = {}
+    section = None
+    # Option whose value goes on on indented lines, and the layer of its rows
+    option = None
+    layer = None
+
+    def error(line, message):
+        return MapError(filename, line, message)
+
+    def add_row(number, row):
+        if layer.width is None:
+            layer.width = len(row)
+        elif len(row) != layer.width:
+            hint = '' if layer is layers['map'] else \
+                " (empty cells at the ends of rows must be '-')"
+            raise error(number, 'row of %d cells in a map of width %d%s'
+                        % (len(row), layer.width, hint))
+        layer.cells += row
+        layer.lines.append(number)
+
+    with open(filename, 'rb') as file:
+        for number, line in enumerate(file, 1):
+            stripped = line.strip()
+            if line[:1] in (b' ', b'\t') and stripped and option is not None:
+                # Continuation line
+                if layer is not None:
+                    add_row(number, stripped)
+                else:
+                    values = level if section == 'level' else keys[section]
+                    values[option] += '\n' + stripped.decode('utf-8')
+                continue
+            option = layer = None
+            if not stripped or stripped[:1] in (b'#', b';'):
+                continue
+            if line[:1] in (b' ', b'\t'):
+                raise error(number, 'indented line out of any option')
+            if stripped.startswith(b'['):
+                if not stripped.endswith(b']'):
+                    raise error(number, 'section header without ]')
+                # Key chars are single bytes, as the cells of the rows
+                section = stripped[1:-1].decode('latin-1')
+                if len(section) == 1:
+                    if section in keys:
+                        raise error(number, 'duplicate key [%s]' % section)
+                    keys[section] = {}
+                    key_lines[section] = {None: number}
+                continue
+            if section is None:
+                raise error(number, 'option out of any section')
+            positions = [i for i in (stripped.find(b'='), stripped.find(b':'))
+                         if i > 0]
+            if not positions:
+                raise error(number, "expected 'name = value'")
+            name = stripped[:min(positions)].strip().decode('latin-1').lower()
+            value = stripped[min(positions) + 1:].strip()
+            option = name
+            if section == 'level' and name in LAYERS:
+                if name in layers:
+                    raise error(number, 'duplicate option %r' % name)
+                layer = layers[name] = _Layer(number)
+                if value:
+                    add_row(number, value)
+                continue
+            try:
+                value = value.decode('utf-8')
+            except UnicodeDecodeError:
+                raise error(number, 'not UTF-8')
+            if section == 'level':
+                if name in level:
+                    raise error(number, 'duplicate option %r' % name)
+                level_lines[name] = number
+                level[name] = value
+            elif section in keys:
+                keys[section][name] = value
+                key_lines[section][name] = number
+            else:
+                # Other sections are not about the level
+                option = None
+
+    data = MapData()
+    if 'map' not in layers:
+        raise error(None, 'no map in the [level] section')
+    for name in ('tileset', 'width', 'height'):
+        if name not in level:
+            raise error(None, 'no %s in the [level] section' % name)
+    data.tileset = level['tileset']
+    try:
+        data.tile_width = int(level['width'])
+        data.tile_height = int(level['height'])
+    except ValueError:
+        name = 'height' if level['width'].strip().isdigit() else 'width'
+        raise error(level_lines[name], '%s must be an integer' % name)
+    ground = layers['map']
+    if not ground.lines:
+        raise error(ground.line, 'empty map')
+    data.width = ground.width
+    data.height = len(ground.lines)
+    for name, rows in layers.items():
+        if rows.lines and rows.width != data.width:
+            raise error(rows.lines[0], 'row of %d cells in a map of width %d'
+                        % (rows.width, data.width))
+        if len(rows.lines) != data.height:
+            raise error(rows.line, '%s has %d rows, the map has %d'
+                        % (name, len(rows.lines), data.height))
+    data.key = keys
+    data.key_table = {char: TileKey(char, attributes, filename,
+                                    key_lines[char])
+                      for char, attributes in keys.items()}
+
+    # Distinct chars of the layers, each of them must have a key
+    codes = [numpy.frombuffer(layers[name].cells, numpy.uint8)
+             for name in LAYERS if name in layers]
+    used = numpy.zeros(256, bool)
+    for cells in codes:
+        used[cells] = True
+    chars = bytes(numpy.flatnonzero(used).tolist()).decode('latin-1')
+    for name, cells in zip([name for name in LAYERS if name in layers],
+                           codes):
+        allowed = set(keys) if name == 'map' else set(keys) | set(EMPTY_CELLS)
+        for char in chars:
+            if char in allowed:
+                continue
+            position = numpy.flatnonzero(cells == ord(char))
+            if len(position):
+                row, column = divmod(int(position[0]), data.width)
+                raise error(layers[name].lines[row],
+                            'unknown key char %r at column %d of %s'
+                            % (char, column + 1, name))
+
+    # Char codes -> indices in chars, translated in place block by block,
+    # so that no copy of the cells is made
+    lookup = numpy.zeros(256, numpy.uint8)
+    lookup[numpy.flatnonzero(used)] = numpy.arange(len(chars))
+    arrays = {}
+    for name, cells in zip([name for name in LAYERS if name in layers],
+                           codes):
+        for start in range(0, len(cells), TRANSLATE_BLOCK):
+            block = cells[start:start + TRANSLATE_BLOCK]
+            block[...] = lookup[block]
+        arrays[name] = cells.reshape(data.height, data.width)
+    data.chars = chars
+    data.indices = arrays.pop('map')
+    data.layers = arrays
+    return data
@@ -0,0 +1,430 @@
+import array
+import bisect
+import collections
+import csv
+import functools
+import json
+import queue
+import threading
+import time
+
+import pygame
+
+# Upper bounds of the buckets of duration histograms, in milliseconds
+TIME_BUCKETS = (0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 4, 8, 12, 16, 20, 25,
+                33, 50, 100)
+
+
+class Histogram:
+    """
+    A histogram counting values into fixed buckets, so that observing a value
+    costs the same whatever the number of values observed.
+
+    :bounds: The sorted upper bounds of the buckets. Values greater than the
+        last bound are counted in an extra overflow bucket.
+    :counts: The number of values observed in each bucket.
+    """
+
+    def __init__(self, bounds=TIME_BUCKETS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, counts, count, total, maximum):
+        """
+        Adds values counted elsewhere, with the same bounds.
+
+        :param counts: The number of the values in each bucket.
+        :param count: The number of the values.
+        :param total: The sum of the values.
+        :param maximum: The maximal value.
+        """
+        self.counts = [old + new for old, new in zip(self.counts, counts)]
+        self.count += count
+        self.total += total
+        if maximum > self.max:
+            self.max = maximum
+
+    def quantile(self, q):
+        """
+        :param q: The quantile to estimate, between 0 and 1.
+        :return: The upper bound of the bucket the quantile falls in (the
+            maximal value for the overflow bucket), None if no value was
+            observed.
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        """
+        :return: A dictionary describing the observed values.
+        """
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else None,
+            'max': self.max,
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99),
+            'buckets': list(self.counts),
+            }
+
+    def reset(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+
+class Metrics:
+    """
+    The metrics of the game: counters, gauges and histograms, updated on the
+    hot path at the cost of a dictionary update, and collected periodically.
+
+    Each collection takes a snapshot of every metric, resets the counters and
+    histograms so that each snapshot describes a single interval, and keeps
+    the snapshot in a ring buffer of the last ones. Snapshots are handed to
+    the exporters, which write them from a separate thread, so that no I/O
+    happens in the game loop.
+
+    Metrics are owned by the thread that created them. Updates made from
+    other threads (such as timing scopes of the level prefetch worker) are
+    queued, and applied by the owner thread on the next collection, so that
+    no lock is taken on the hot path. Values measured together on every
+    frame are recorded in a Batch instead, counted on collection.
+
+    :enabled: False to make every update a no-op.
+    :sample_period: Costly measures (such as timing every single call) are
+        only taken once every sample_period times.
+    :counters: A dictionary name -> count since the last collection.
+    :gauges: A dictionary name -> last value set.
+    :histograms: A dictionary name -> Histogram of the values observed since
+        the last collection.
+    :history: The ring buffer of the last snapshots, oldest first.
+    :exporters: The exporters snapshots are written to.
+    """
+
+    def __init__(self, exporters=(), history=300, enabled=True,
+                 sample_period=16):
+        self.enabled = enabled
+        self.sample_period = sample_period
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.history = collections.deque(maxlen=history)
+        self.exporters = list(exporters)
+        self._queue = None
+        self._writer = None
+        self._thread = threading.get_ident()
+        # (update method, arguments) of the updates made from other threads
+        self._pending = collections.deque()
+        self._batches = []
+
+    def inc(self, name, value=1):
+        """
+        Increments a counter.
+        """
+        if self.enabled:
+            if threading.get_ident() != self._thread:
+                self._pending.append((self.inc, (name, value)))
+                return
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set(self, name, value):
+        """
+        Sets a gauge.
+        """
+        if self.enabled:
+            if threading.get_ident() != self._thread:
+                self._pending.append((self.set, (name, value)))
+                return
+            self.gauges[name] = value
+
+    def observe(self, name, value, bounds=TIME_BUCKETS):
+        """
+        Counts a value in a histogram.
+
+        :param bounds: The bucket bounds of the histogram, if it does not
+            exist yet.
+        """
+        if self.enabled:
+            if threading.get_ident() != self._thread:
+                self._pending.append((self.observe, (name, value, bounds)))
+                return
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram(bounds)
+            histogram.observe(value)
+
+    def batch(self, histograms, counters=(), bounds=TIME_BUCKETS):
+        """
+        :return: A new Batch of these metrics, see Batch.
+        """
+        batch = Batch(self, histograms, counters, bounds)
+        self._batches.append(batch)
+        return batch
+
+    def collect(self, interval):
+        """
+        Takes a snapshot of the metrics, starts a new interval and exports
+        the snapshot.
+
+        :param interval: The duration of the interval that ends, in seconds.
+        :return: The snapshot, a dictionary with 'time', 'interval',
+            'counters', 'gauges' and 'histograms' (name -> summary) entries.
+        """
+        # deque.popleft is atomic, other threads may go on appending
+        while self._pending:
+            update, args = self._pending.popleft()
+            update(*args)
+        for batch in self._batches:
+            batch.count()
+        snapshot = {
+            'time': time.time(),
+            'interval': interval,
+            'counters': dict(self.counters),
+            'gauges': dict(self.gauges),
+            'histograms': {name: histogram.summary()
+                           for name, histogram in self.histograms.items()},
+            }
+        for name in self.counters:
+            self.counters[name] = 0
+        for histogram in self.histograms.values():
+            histogram.reset()
+        self.history.append(snapshot)
+        if self.exporters:
+            if self._writer is None:
+                self._queue = queue.Queue()
+                self._writer = threading.Thread(target=self._write,
+                                                daemon=True)
+                self._writer.start()
+            self._queue.put(snapshot)
+        return snapshot
+
+    def _write(self):
+        while True:
+            snapshot = self._queue.get()
+            if snapshot is None:
+                break
+            for exporter in self.exporters:
+                exporter.export(snapshot)
+
+    def close(self):
+        """
+        Waits for the pending snapshots to be written, then closes the
+        exporters.
+        """
+        if self._writer is not None:
+            self._queue.put(None)
+            self._writer.join()
+            self._writer = None
+        for exporter in self.exporters:
+            exporter.close()
+
+
+class Batch:
+    """
+    Values measured together on every frame, such as the timings of its
+    phases, observed in histograms and added to counters of a Metrics.
+    Recording them only appends their raw values to an array: they are
+    counted all at once when the metrics are collected, so that the hot
+    path pays for a single cheap update.
+
+    Unlike the other updates of the metrics, batches are only recorded from
+    the thread owning the metrics.
+
+    :histograms: A tuple of (histogram name, key in the recorded values)
+        pairs.
+    :counters: A tuple of (counter name, key in the recorded values) pairs,
+        a None key counting 1 per record.
+    :bounds: The bucket bounds of the histograms, if they do not exist yet.
+    """
+
+    def __init__(self, metrics, histograms, counters=(), bounds=TIME_BUCKETS):
+        self.metrics = metrics
+        self.histograms = tuple(histograms)
+        self.counters = tuple(counters)
+        self.bounds = bounds
+        self._keys = [key for _, key in self.histograms + self.counters
+                      if key is not None]
+        self._values = array.array('d')
+
+    def record(self, values):
+        """
+        :param values: A dictionary key -> value of the measured values.
+        """
+        if self.metrics.enabled:
+            self._values.extend([values[key] for key in self._keys])
+
+    def count(self):
+        """
+        Counts the recorded values into the metrics, from the owner thread.
+        """
+        values, self._values = self._values, array.array('d')
+        if not values:
+            return
+        metrics = self.metrics
+        width = len(self._keys)
+        records = len(values) // width
+        # Recorded values of each key, sliced out of the array
+        columns = {key: values[index::width]
+                   for index, key in enumerate(self._keys)}
+        for name, key in self.counters:
+            metrics.counters[name] = metrics.counters.get(name, 0) + (
+                records if key is None else int(sum(columns[key])))
+        bucket = functools.partial(bisect.bisect_left, self.bounds)
+        for name, key in self.histograms:
+            histogram = metrics.histograms.get(name)
+            if histogram is None:
+                histogram = metrics.histograms[name] = Histogram(self.bounds)
+            column = columns[key]
+            counts = collections.Counter(map(bucket, column))
+            histogram.merge([counts[index] for index in range(
+                len(self.bounds) + 1)], records, sum(column), max(column))
+
+
+def flatten(snapshot):
+    """
+    :param snapshot: A snapshot, from Metrics.collect.
+    :return: The snapshot as a flat dictionary of numbers, with
+        'counters.<name>', 'gauges.<name>' and '<histogram>.<stat>' keys.
+    """
+    row = {'time': snapshot['time'], 'interval': snapshot['interval']}
+    for name, value in snapshot['counters'].items():
+        row['counters.' + name] = value
+    for name, value in snapshot['gauges'].items():
+        row['gauges.' + name] = value
+    for name, summary in snapshot['histograms'].items():
+        for stat, value in summary.items():
+            if stat != 'buckets':
+                row[name + '.' + stat] = value
+    return row
+
+
+class JsonLinesExporter:
+    """
+    Writes each snapshot as a JSON object on its own line of a file.
+    """
+
+    def __init__(self, filename):
+        self.file = open(filename, 'w')
+
+    def export(self, snapshot):
+        self.file.write(json.dumps(snapshot) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class CsvExporter:
+    """
+    Writes each snapshot as a row of a CSV file, flattened by flatten. The
+    columns are the ones of the first snapshot: metrics appearing later are
+    not written.
+    """
+
+    def __init__(self, filename):
+        self.file = open(filename, 'w', newline='')
+        self.writer = None
+
+    def export(self, snapshot):
+        row = flatten(snapshot)
+        if self.writer is None:
+            self.writer = csv.DictWriter(self.file, list(row),
+                                         extrasaction='ignore')
+            self.writer.writeheader()
+        self.writer.writerow(row)
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class MemoryExporter:
+    """
+    Keeps every snapshot in a list, for tests and benchmarks.
+    """
+
+    def __init__(self):
+        self.snapshots = []
+
+    def export(self, snapshot):
+        self.snapshots.append(snapshot)
+
+    def close(self):
+        pass
+
+
+def exporter_for(filename):
+    """
+    :return: The exporter writing to filename, CSV for a .csv file, JSON
+        lines otherwise.
+    """
+    if filename.endswith('.csv'):
+        return CsvExporter(filename)
+    return JsonLinesExporter(filename)
+
+
+class MetricsOverlay:
+    """
+    Shows the last snapshot of some metrics on the screen. The text is only
+    rendered again when a new snapshot was collected.
+
+    :metrics: The Metrics to show.
+    :names: The flattened names (see flatten) of the metrics shown.
+    """
+
+    def __init__(self, metrics, names, font_size=14):
+        self.metrics = metrics
+        self.names = names
+        self.font_size = font_size
+        self._font = None
+        self._snapshot = None
+        self._surface = None
+
+    def render(self):
+        """
+        :return: The Surface of the overlay, None until the first snapshot.
+        """
+        if not self.metrics.history:
+            return None
+        snapshot = self.metrics.history[-1]
+        if snapshot is not self._snapshot:
+            if self._font is None:
+                self._font = pygame.font.Font(None, self.font_size)
+            row = flatten(snapshot)
+            lines = [self._font.render('%s: %s' % (name, format_value(
+                row.get(name))), True, (255, 255, 255), (0, 0, 0))
+                     for name in self.names]
+            width = max(line.get_width() for line in lines)
+            height = sum(line.get_height() for line in lines)
+            self._surface = pygame.Surface((width, height))
+            y = 0
+            for line in lines:
+                self._surface.blit(line, (0, y))
+                y += line.get_height()
+            self._snapshot = snapshot
+        return self._surface
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return '%.2f' % value
+    return str(value)
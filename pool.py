@@ -0,0 +1,163 @@
+import sys
+
+
+def entity_size(entity):
+    """
+    :return: The memory taken by an entity, in bytes: the object itself, its
+        attribute dictionary if it has one, and the containers it holds
+        directly. Surfaces and other entities it refers to are shared, thus
+        not counted.
+    """
+    size = sys.getsizeof(entity)
+    values = []
+    for cls in type(entity).__mro__:
+        for name in cls.__dict__.get('__slots__', ()):
+            try:
+                values.append(getattr(entity, name))
+            except AttributeError:
+                pass
+    if hasattr(entity, '__dict__'):
+        size += sys.getsizeof(entity.__dict__)
+        values.extend(entity.__dict__.values())
+    for value in values:
+        if isinstance(value, (list, tuple, dict, set)):
+            size += sys.getsizeof(value)
+    return size
+
+
+class EntityPool:
+    """
+    A pool of entities of a class, so that short-lived entities (collected
+    coins, drops, projectiles...) are reused instead of being created and
+    garbage collected over and over.
+
+    Entities are acquired from the pool with the arguments of the
+    constructor of the class, and released to it once done with, usually
+    with Entity.release. A released entity is removed from its grid and
+    emptied (Entity.on_release), then reset (Entity.reset) with the new
+    arguments when acquired again.
+
+    :cls: The class of the entities.
+    :capacity: The maximal number of free entities kept, None for no limit.
+    :hits: The number of entities acquired by reusing a free one.
+    :misses: The number of entities acquired by creating a new one.
+    :in_use: The number of entities acquired and not released yet.
+    :entity_bytes: The memory taken by an entity, as measured once, on the
+        first one released (see entity_size), None if none was released
+        yet.
+    """
+
+    def __init__(self, cls, capacity=None):
+        self.cls = cls
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self.in_use = 0
+        self.entity_bytes = None
+        self._free = []
+
+    def __len__(self):
+        """
+        :return: The number of free entities.
+        """
+        return len(self._free)
+
+    @property
+    def hit_rate(self):
+        """
+        The ratio of the entities acquired by reusing a free one, None if no
+        entity was acquired yet.
+        """
+        acquired = self.hits + self.misses
+        return self.hits / acquired if acquired else None
+
+    def acquire(self, *args, **kwargs):
+        """
+        :return: An entity of the class of the pool, as built with the given
+            arguments, reused if a free one is available.
+        """
+        if self._free:
+            entity = self._free.pop()
+            entity.reset(*args, **kwargs)
+            self.hits += 1
+        else:
+            entity = self.cls(*args, **kwargs)
+            self.misses += 1
+        entity._pool = self
+        self.in_use += 1
+        return entity
+
+    def release(self, entity):
+        """
+        Gives an entity acquired from the pool back to it, removing it from
+        its grid. The entity must not be used anymore.
+
+        :return: True if the entity was released, False if it does not come
+            from this pool, or was already released.
+        """
+        if entity._pool is not self:
+            return False
+        if entity._grid is not None:
+            entity._grid.remove_entity(entity)
+        if self.entity_bytes is None:
+            self.entity_bytes = entity_size(entity)
+        entity.on_release()
+        entity._pool = None
+        self.in_use -= 1
+        if self.capacity is None or len(self._free) < self.capacity:
+            self._free.append(entity)
+        return True
+
+    def clear(self):
+        """
+        Drops the free entities.
+        """
+        self._free.clear()
+
+
+class Pools:
+    """
+    The entity pools of the game, one per class, created on first use.
+    """
+
+    def __init__(self):
+        self._pools = {}
+
+    def __iter__(self):
+        return iter(self._pools.values())
+
+    def get(self, cls):
+        """
+        :return: The EntityPool of a class.
+        """
+        pool = self._pools.get(cls)
+        if pool is None:
+            pool = self._pools[cls] = EntityPool(cls)
+        return pool
+
+    def acquire(self, cls, *args, **kwargs):
+        """
+        Acquires an entity from the pool of its class, see
+        EntityPool.acquire.
+        """
+        return self.get(cls).acquire(*args, **kwargs)
+
+    def report(self, metrics):
+        """
+        Sets the gauges of every pool: hit rate, memory per entity, entities
+        in use and free entities, suffixed by the name of the class.
+
+        :param metrics: The metrics.Metrics to set the gauges of.
+        """
+        for pool in self._pools.values():
+            name = pool.cls.__name__
+            if pool.hit_rate is not None:
+                metrics.set('pool-hit-rate.' + name, pool.hit_rate)
+            if pool.entity_bytes is not None:
+                metrics.set('pool-entity-bytes.' + name, pool.entity_bytes)
+            metrics.set('pool-in-use.' + name, pool.in_use)
+            metrics.set('pool-free.' + name, len(pool))
+
+
+# Pools shared by every grid
+pools = Pools()
@@ -0,0 +1,172 @@
+import asyncio
+import cProfile
+import time
+import tracemalloc
+
+
+class _NullScope:
+    """
+    The scope returned when profiling is disabled, doing nothing.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class _Scope:
+    """
+    A timing scope, observing its duration in milliseconds in a histogram of
+    the profiler's metrics.
+    """
+    __slots__ = ('metrics', 'name', 'start')
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.name,
+                             1e3 * (time.perf_counter() - self.start))
+        return False
+
+
+_NULL_SCOPE = _NullScope()
+
+
+class Profiler:
+    """
+    Profiling hooks of the game. The code of the game is instrumented by
+    timing scopes:
+
+        with profiler.scope('level.load'):
+            ...
+
+    When the profiler is enabled, the duration of each scope is observed in
+    the 'scope.<name>' histogram of its metrics. When it is disabled, scope
+    is bound to a method returning a shared no-op context manager, so a
+    scope allocates nothing, tests nothing and measures no time.
+
+    Independently, the profiler can capture a cProfile profile, and
+    optionally tracemalloc snapshots, of the next frames, and dump them to
+    files.
+
+    :enabled: True if timing scopes are measured.
+    :metrics: The Metrics scopes are observed in.
+    :capturing: True while a capture is running.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.metrics = None
+        self.capturing = False
+        self._profile = None
+        self._frames_left = 0
+        self._filename = None
+        self._memory = False
+
+    def enable(self, metrics):
+        """
+        Starts measuring timing scopes.
+
+        :param metrics: The Metrics scopes are observed in.
+        """
+        self.metrics = metrics
+        self.enabled = True
+        # Shadows the no-op scope method of the class
+        self.scope = self._timed_scope
+
+    def disable(self):
+        self.enabled = False
+        self.__dict__.pop('scope', None)
+
+    def scope(self, name):
+        """
+        :param name: The name of the scope, such as 'update.player'.
+        :return: A context manager timing its body, the shared no-op one
+            while the profiler is disabled.
+        """
+        return _NULL_SCOPE
+
+    def _timed_scope(self, name):
+        return _Scope(self.metrics, 'scope.' + name)
+
+    async def loop_lag(self, running, interval=0.1):
+        """
+        An asynchronous loop function measuring the event loop lag: how late
+        asyncio.sleep wakeups land compared to when they were due, observed
+        in milliseconds in the 'loop-lag' histogram. A large lag means some
+        task blocks the event loop.
+
+        :param running: A function returning False when the loop must stop.
+        :param interval: The time slept between two measures, in seconds.
+        """
+        while running():
+            start = time.perf_counter()
+            await asyncio.sleep(interval)
+            lag = time.perf_counter() - start - interval
+            if self.enabled:
+                self.metrics.observe('loop-lag', 1e3 * max(0.0, lag))
+
+    def capture(self, frames, filename, memory=False):
+        """
+        Profiles the next frames with cProfile, then dumps the statistics to
+        filename + '.prof' (to be read with pstats). Ignored if a capture is
+        already running.
+
+        :param frames: The number of frames to profile.
+        :param filename: The path of the dumps, without extension.
+        :param memory: True to also trace memory allocations with
+            tracemalloc, and dump a snapshot of them to filename +
+            '.tracemalloc' (to be read with tracemalloc.Snapshot.load).
+        """
+        if self.capturing:
+            return
+        self.capturing = True
+        self._frames_left = frames
+        self._filename = filename
+        self._memory = memory and not tracemalloc.is_tracing()
+        if self._memory:
+            tracemalloc.start()
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+
+    def end_frame(self):
+        """
+        Tells the profiler a frame ended, so that a capture stops after its
+        last frame. Costs nothing but a test when no capture is running.
+        """
+        if self.capturing:
+            self._frames_left -= 1
+            if self._frames_left <= 0:
+                self.stop_capture()
+
+    def stop_capture(self):
+        """
+        Stops the running capture, and dumps it.
+
+        :return: The list of the files written.
+        """
+        if not self.capturing:
+            return []
+        self._profile.disable()
+        files = [self._filename + '.prof']
+        self._profile.dump_stats(files[0])
+        if self._memory:
+            files.append(self._filename + '.tracemalloc')
+            tracemalloc.take_snapshot().dump(files[1])
+            tracemalloc.stop()
+        self._profile = None
+        self.capturing = False
+        print('Profile written to ' + ', '.join(files))
+        return files
+
+
+# Profiler of the game, shared by every module
+profiler = Profiler()
@@ -0,0 +1,242 @@
+import pygame
+
+# Drawing layers, drawn in increasing order
+ENTITY_LAYER = 1
+OVERHEAD_LAYER = 2
+UI_LAYER = 3
+
+
+class RenderQueue:
+    """
+    A queue of what has to be drawn on a frame. Surfaces are submitted with
+    their screen position and layer, then drawn all at once by flush, with a
+    single Surface.blits call per layer, in increasing layer order. Within a
+    layer, surfaces are drawn in submission order.
+
+    The buffers of the layers are kept from one frame to another, so that
+    submitting does not allocate once they are large enough.
+    """
+
+    def __init__(self, capacity=256):
+        self._capacity = capacity
+        # layer -> [buffer of (surface, position), number of items]
+        self._layers = {}
+
+    def submit(self, surface, position, layer=ENTITY_LAYER, area=None):
+        """
+        Queues a surface to be drawn.
+
+        :param surface: The surface to draw.
+        :param position: The position on the screen of the top left corner of
+            the surface.
+        :param layer: The layer to draw the surface in.
+        :param area: If given, the pygame.Rect of the part of the surface to
+            draw.
+        """
+        item = (surface, position) if area is None \
+            else (surface, position, area)
+        try:
+            entry = self._layers[layer]
+        except KeyError:
+            entry = self._layers[layer] = [[None] * self._capacity, 0]
+        buffer, count = entry
+        if count < len(buffer):
+            buffer[count] = item
+        else:
+            buffer.append(item)
+        entry[1] = count + 1
+
+    def flush(self, screen):
+        """
+        Draws every queued surface on the screen, then empties the queue.
+
+        :param screen: The surface to draw on.
+        """
+        for layer in sorted(self._layers):
+            entry = self._layers[layer]
+            buffer, count = entry
+            if count:
+                screen.blits(buffer[:count] if count < len(buffer) else buffer,
+                             0)
+                # Release the surfaces, the buffer itself is kept
+                buffer[:count] = [None] * count
+                entry[1] = 0
+
+    def __len__(self):
+        return sum(count for _, count in self._layers.values())
+
+
+class DirtyRenderer:
+    """
+    A renderer updating only the parts of the screen that changed since the
+    last frame, as an alternative to redrawing and flipping the whole screen
+    on every frame.
+
+    While the view does not move, the screen rectangles of the objects that
+    moved, changed sprite, appeared or disappeared are redrawn (background
+    then every object overlapping them), and only these rectangles are
+    pushed to the display. When the view moves or the map changes, the whole
+    screen is redrawn and flipped.
+
+    :screen: The pygame.Surface object representing the screen.
+    :display: What the screen is presented with, providing flip and
+        update(rects) as pygame.display does: pygame.display by default, or
+        the FrameScaler of a low resolution screen.
+    :full_redraw: True if the next frame has to be fully redrawn.
+    """
+
+    def __init__(self, screen, display=pygame.display):
+        self.screen = screen
+        self.display = display
+        self.full_redraw = True
+        self.queue = RenderQueue()
+        self._view = None
+        # key -> (surface, screen rect) of what was drawn on last frame
+        self._drawn = {}
+
+    def present(self, game, clock=None, redrawn=()):
+        """
+        Draws the game and updates the display.
+
+        :param game: The LlnRpg object to draw, providing draw,
+            draw_background and drawables.
+        :param clock: If given, the GameClock the drawing time is recorded
+            in, as the 'draw' lap.
+        :param redrawn: The list of the pygame.Rect of the screen where the
+            background changed, such as its animated tiles.
+        :return: The list of the updated rectangles, None if the whole screen
+            was flipped.
+        """
+        items = game.drawables()
+        drawn = {key: (surface, pygame.Rect(position, surface.get_size()))
+                 for key, surface, position, _ in items}
+        # The background changes with the view, the level and its tiles
+        view = (game.grid.view_coord, game.grid.level, game.grid.level.version)
+        try:
+            if self.full_redraw or view != self._view:
+                game.draw()
+                if clock is not None:
+                    clock.lap('draw')
+                self.display.flip()
+                self.full_redraw = False
+                return None
+            dirty = self.dirty_rects(drawn, redrawn)
+            overhead = game.grid.overhead_blits()
+            for rect in dirty:
+                self.screen.set_clip(rect)
+                game.draw_background()
+                for key, surface, position, layer in items:
+                    if rect.colliderect(drawn[key][1]):
+                        self.queue.submit(surface, position, layer)
+                for surface, position, area in overhead:
+                    self.queue.submit(surface, position, OVERHEAD_LAYER, area)
+                self.queue.flush(self.screen)
+            self.screen.set_clip(None)
+            if clock is not None:
+                clock.lap('draw')
+            self.display.update(dirty)
+            return dirty
+        finally:
+            self._view = view
+            self._drawn = drawn
+
+    def dirty_rects(self, drawn, redrawn=()):
+        """
+        :param drawn: A dictionary key -> (surface, screen rect) of what has
+            to be drawn on this frame.
+        :param redrawn: The list of the screen rectangles where the
+            background changed.
+        :return: The list of the screen rectangles that changed since last
+            frame.
+        """
+        screen_rect = self.screen.get_rect()
+        dirty = list(redrawn)
+        for key, (surface, rect) in drawn.items():
+            old = self._drawn.get(key)
+            if old is None:
+                dirty.append(rect)
+            elif old[0] is not surface or old[1] != rect:
+                dirty.append(old[1])
+                dirty.append(rect)
+        for key in self._drawn.keys() - drawn.keys():
+            dirty.append(self._drawn[key][1])
+        dirty = [rect.clip(screen_rect) for rect in dirty]
+        return [rect for rect in dirty if rect.width and rect.height]
+
+
+class FrameScaler:
+    """
+    Presents a low resolution frame on the window: the game is drawn on a
+    frame scale times smaller than the window, at the native resolution of
+    the tiles, and the frame is upscaled to the window once, when presented.
+    Drawing, and the backgrounds kept in memory, are then scale**2 times
+    smaller.
+
+    It provides flip and update(rects) as pygame.display does, so that it
+    can be used in its place. With a scale of 1, the frame is the window
+    itself and nothing is scaled.
+
+    :window: The pygame.Surface object of the window.
+    :scale: The integer factor the frame is upscaled by.
+    :smooth: True to upscale with smooth filtering, False for nearest
+        neighbour, keeping the pixels sharp.
+    :frame: The pygame.Surface to draw on.
+    """
+
+    def __init__(self, window, scale=1, smooth=False):
+        self.window = window
+        self.scale = scale
+        self.smooth = smooth
+        if scale == 1:
+            self.frame = window
+        else:
+            width, height = window.get_size()
+            self.frame = pygame.Surface((width // scale, height // scale), 0,
+                                        window)
+
+    def upscale(self, rect=None):
+        """
+        Upscales a part of the frame onto the window.
+
+        :param rect: The pygame.Rect of the frame to upscale, None for the
+            whole frame.
+        :return: The pygame.Rect of the window that was drawn.
+        """
+        scale = self.scale
+        if rect is None:
+            rect = self.frame.get_rect()
+        target = pygame.Rect(rect.x * scale, rect.y * scale,
+                             rect.width * scale, rect.height * scale)
+        target = target.clip(self.window.get_rect())
+        if target.width and target.height:
+            transform = pygame.transform.smoothscale if self.smooth \
+                else pygame.transform.scale
+            transform(self.frame.subsurface(rect), target.size,
+                      self.window.subsurface(target))
+        return target
+
+    def flip(self):
+        """
+        Upscales the whole frame, and displays it.
+        """
+        if self.frame is not self.window:
+            self.upscale()
+        pygame.display.flip()
+
+    def update(self, rects):
+        """
+        Upscales parts of the frame, and displays them.
+
+        :param rects: The list of the pygame.Rect of the frame to display.
+        """
+        if self.frame is not self.window:
+            rects = [self.upscale(rect) for rect in rects]
+        pygame.display.update(rects)
+
+    def to_frame(self, position):
+        """
+        :param position: A (x, y) position in the window, such as the one of
+            the mouse.
+        :return: The corresponding position in the frame.
+        """
+        return position[0] // self.scale, position[1] // self.scale
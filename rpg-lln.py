@@ -3,15 +3,42 @@ import pygame
 import pygame.locals
 from grid import Grid
 from entities import Coin, Entity, Player
+from render import DirtyRenderer, FrameScaler, RenderQueue, ENTITY_LAYER, \
+    OVERHEAD_LAYER, UI_LAYER
+from clock import GameClock
+from metrics import Metrics, MetricsOverlay, exporter_for
+from profiling import profiler
+from assets import assets
+from pool import pools
+from sprites import SpriteAtlas
 import time
 import sys
+import os
+import io
+import math
+import argparse
 import asyncio
+import functools
 
 if sys.version_info < (3, 7):
     raise RuntimeError('Python3.7+ needed to run.')
 
+# Icons of the sound button, when sound is played or muted
+SOUND_ICONS = {True: 'images/sound_icon.png',
+               False: 'images/no_sound_icon.png'}
+# Distance, in tiles, from the player within which sleeping entities are
+# woken up when it moves
+WAKE_RADIUS = 8
+# (metric, key in GameClock.timings) of the histograms and counters recorded
+# every frame, see metrics.Batch
+FRAME_HISTOGRAMS = (('frame-interval', 'interval'),
+                    ('update-time', 'update'),
+                    ('draw-time', 'draw'),
+                    ('present-time', 'present'),
+                    ('sleep-overshoot', 'sleep-overshoot'))
+FRAME_COUNTERS = (('frames', None), ('ticks', 'ticks'),
+                  ('dropped-ticks', 'dropped'))
 
-# TODO perf bench compared to synchronously managed tasks
 
 def get_direction(direction):
     """
@@ -39,11 +66,18 @@ class LlnRpg:
     dig into the code and the way it works, you will first need to see the
     python doc's section about asynchronous programming in python.
 
-    :[class] monitoring_data: A dictionary storing monitored data about the
-        game execution.
+    :metrics: The Metrics storing monitored data about the game execution.
+    :frame_metrics: The metrics.Batch of the timings recorded every frame.
+    :metrics_overlay: The MetricsOverlay shown on the screen, None if there
+        is none.
+    :profile_frames: The number of frames profiled by a capture (F9 key).
+    :profile_memory: True if captures also trace memory allocations.
     :grid_width: The width (in tiles) of the grid.
     :grid_height: The height (in tiles) of the grid.
     :screen: The pygame.Surface object representing the screen.
+    :scaler: The render.FrameScaler presenting the frame on the screen.
+    :canvas: The pygame.Surface the game is drawn on, the screen itself
+        unless the game is drawn at a lower resolution.
     :grid: The Grid object representing the map.
     :player: the Player object representing the player.
     :sound_button: The pygame.Surface object representing the sound button.
@@ -51,6 +85,26 @@ class LlnRpg:
         hitbox.
     :sound_played: True if sound is played, False if muted.
     :running: True if game is running, False otherwise.
+    :headless: True if the game runs without display nor sound.
+    :clock: The GameClock pacing frames and simulation ticks, and timing
+        frames.
+    :next_frame: The time (from time.perf_counter) the next frame is due.
+    :interpolate: True if the positions drawn are interpolated between the
+        last two ticks.
+    :previous_pos: A dictionary entity -> map_pos of the player and the
+        visible entities before the last tick, used for interpolation.
+    :event_handlers: A dictionary dispatching each handled event type to its
+        handler. Other event types are not even queued.
+    :key_down_actions: A dictionary dispatching each handled pressed key to
+        its action.
+    :key_up_actions: A dictionary dispatching each handled released key to
+        its action.
+    :ticks: The number of game ticks simulated so far.
+    :started: The time (from time.perf_counter) the game was created.
+    :first_frame_time: The time it took from the creation of the game to its
+        first frame, in seconds, None until the first frame.
+    :music_loaded: True once the music is loaded. The music is loaded in the
+        background, the game does not wait for it to start.
 
     """
     key_direction_mapping = {
@@ -62,18 +116,6 @@ class LlnRpg:
         pygame.locals.K_d: 3,
         }
 
-    monitoring_data = {
-        'events': 0.0,
-        'handled-events': 0.0,
-        'clicks': 0.0,
-        'handled-clicks': 0.0,
-        'frames': 0.0,
-        'handle_events-loops': 0.0,
-        'monitoring-interval': 0.0,
-        'player-balance': 0.0,
-        'entity-number': 0.0,
-        }
-
     def __init__(self, **kwargs):
         """
         All arguments are keyword-arguments. All have default values (in
@@ -89,11 +131,66 @@ class LlnRpg:
             relative to the top left corner of the screen (128, 64).
         :param play_sound: True to start playing sound, False to start with
             sound muted (False).
-        :param base_delay: Minimal delay to wait between each asynchronous
-            call of the same function. Useless to give < 1e-4. This should
-            not be changed since it affects a lot the way the game behave and
-            its performances (1e-3).
+        :param base_delay: Minimal delay to sleep when waiting for events.
+            The game sleeps until the next frame is due (or, with play_sync,
+            until an event happens), this only avoids waking up too often
+            when a frame is almost due.
+            Useless to give < 1e-3, since events are waited with a
+            millisecond resolution (1e-3).
+        :param tick_rate: Number of simulation ticks per second, whatever
+            the frame rate (60).
+        :param target_fps: Number of frames per second to aim at, None for
+            as many as possible (60).
+        :param max_ticks: Maximal number of ticks simulated in a single
+            frame to catch up with real time. The game slows down rather
+            than simulating more when frames are too slow (5).
+        :param interpolate: True to draw the positions interpolated between
+            the last two ticks, for smooth movement when the frame rate is
+            not the tick rate (False).
+        :param vsync: True to synchronise the display flips with the screen
+            refresh, if supported (False).
+        :param music_file: The music to play, None for no music
+            ('sound/lln_sound.wav').
+        :param headless: True to run without display nor sound, using SDL
+            dummy drivers (False).
+        :param chunk_size: If given, the map background is streamed by
+            square chunks of chunk_size tiles around the view, instead of
+            being rendered at once. For huge maps (None).
+        :param chunk_memory: The memory budget of the background chunks, in
+            bytes (64 MiB).
+        :param level_memory: The memory budget of the cache of the levels
+            loaded so far or prefetched, in bytes (64 MiB).
+        :param render_scale: The game is drawn render_scale times smaller
+            than the screen, then upscaled to it once per frame, see
+            render.FrameScaler. None to draw the tiles at the native
+            resolution of the tileset (1, None when chunk_size is given).
+        :param smooth_scaling: True to upscale the frame with smooth
+            filtering, False for nearest neighbour (False).
+        :param sprite_atlas: True to pack the sprites of the entities into
+            a sprites.SpriteAtlas of the grid (False).
+        :param metrics_file: If given, the file the metrics are written to
+            every second, as CSV if it ends with .csv, as JSON lines
+            otherwise (None).
+        :param metrics_overlay: True to show the main metrics on the screen
+            (False).
+        :param profile: True to time the loops and the phases of each frame
+            into the metrics ('scope.*' histograms), and to monitor the
+            event loop lag ('loop-lag'). Costs nothing when disabled (False).
+        :param profile_frames: Number of frames profiled with cProfile when
+            F9 is pressed (120).
+        :param profile_memory: True to also capture tracemalloc snapshots
+            when F9 is pressed (False).
+        :param dirty_rects: True to redraw and update only the parts of the
+            screen that changed since last frame when the view does not move,
+            instead of flipping the whole screen (False).
         """
+        self.started = time.perf_counter()
+        self.first_frame_time = None
+        self.headless = kwargs.get('headless', False)
+        if self.headless:
+            # Must be set before the display and mixer are initialised
+            os.environ['SDL_VIDEODRIVER'] = 'dummy'
+            os.environ['SDL_AUDIODRIVER'] = 'dummy'
         self.azerty = kwargs.get('azerty', True)
         if self.azerty:
             self.key_direction_mapping[pygame.locals.K_z] = 0
@@ -105,17 +202,53 @@ class LlnRpg:
         self.grid_width = kwargs.get('grid_width', 30)
         self.grid_height = kwargs.get('grid_height', 20)
 
-        self.screen = pygame.display.set_mode(kwargs.get('screen_mode',
-                                                         (960, 640)))
+        screen_mode = kwargs.get('screen_mode', (960, 640))
+        self.screen = None
+        if kwargs.get('vsync', False) and not self.headless:
+            try:
+                # pygame only supports vsync with scaled or OpenGL displays
+                self.screen = pygame.display.set_mode(screen_mode,
+                                                      pygame.SCALED, vsync=1)
+            except pygame.error:
+                print('vsync not supported, frames are paced by timer')
+        if self.screen is None:
+            self.screen = pygame.display.set_mode(screen_mode)
+        # Start loading the assets, they are decoded in parallel while the
+        # map is loaded
+        self.music_file = None if self.headless else \
+            kwargs.get('music_file', 'sound/lln_sound.wav')
+        if self.music_file is not None:
+            assets.load_data(self.music_file)
+        assets.preload([file for file, _, _ in Player.sprites_files['male']]
+                       + ['res/coin.png'] + list(SOUND_ICONS.values()))
+        self.music_loaded = False
+        self.draw_loading()
         self.grid = Grid(kwargs.get('map_file', "level.map"),
                          self.screen,
                          (self.grid_width, self.grid_height),
-                         kwargs.get('map_pos', (32*4, 32*2)))
+                         kwargs.get('map_pos', (32*4, 32*2)),
+                         kwargs.get('chunk_size'),
+                         kwargs.get('chunk_memory', 64 * 2**20),
+                         kwargs.get('level_memory', 64 * 2**20),
+                         kwargs.get('render_scale',
+                                    None if kwargs.get('chunk_size') else 1),
+                         SpriteAtlas() if kwargs.get('sprite_atlas', False)
+                         else None)
+        # The game is drawn on the frame of the scaler, sprites are loaded
+        # at its resolution (the scale of the grid)
+        self.scaler = FrameScaler(self.screen, self.grid.scale,
+                                  kwargs.get('smooth_scaling', False))
+        self.canvas = self.scaler.frame
+        self.draw_loading()
         self.player = Player(self.screen, self.grid, 'male')
+        # Last tile the player was seen on, to detect it stepped on an exit
+        self.player_tile = self.player.pos
         # Create coins
         for p in [(8, 10), (9, 11), (10, 10), (8, 12), (10, 12)]:
-            coin = Coin(tuple(numpy.multiply(self.grid.tilesize, 0.75)), 10)
-            coin.load_sprites('res/coin.png', 1, 1)
+            coin = pools.acquire(
+                Coin, tuple(numpy.multiply(self.grid.tilesize, 0.75)), 10)
+            coin.load_sprites('res/coin.png', 1, 1, self.grid.scale,
+                              self.grid.atlas)
             coin.set_pos(self.grid, p)
             self.grid.add_entity(coin)
         # Array storing arrow key inputs
@@ -126,68 +259,84 @@ class LlnRpg:
         self.running = False
 
         self.sound_played = not kwargs.get('play_sound', False)
-        # Useless  to go < 1e-4, this controls game tick speed
-        # (roughly, not the same as fps)
-        # Think of it as "how fast will the game compute things"
+        # Minimal sleep time of the event loop
         self.base_delay = kwargs.get('base_delay', 1e-3)
+        # Paces frames and simulation ticks
+        self.clock = GameClock(kwargs.get('tick_rate', 60),
+                               kwargs.get('target_fps', 60),
+                               kwargs.get('max_ticks', 5))
+        self.interpolate = kwargs.get('interpolate', False)
+        self.previous_pos = {}
+        metrics_file = kwargs.get('metrics_file')
+        self.metrics = Metrics(
+            [] if metrics_file is None else [exporter_for(metrics_file)])
+        self.frame_metrics = self.metrics.batch(FRAME_HISTOGRAMS,
+                                                FRAME_COUNTERS)
+        self.metrics_overlay = MetricsOverlay(self.metrics, [
+            'counters.frames', 'counters.ticks', 'frame-interval.p90',
+            'update-time.p90', 'draw-time.p90', 'event-latency.p90',
+            ]) if kwargs.get('metrics_overlay', False) else None
+        # Time the oldest event not shown on screen yet was handled
+        self.pending_event = None
+        if kwargs.get('profile', False):
+            profiler.enable(self.metrics)
+        self.profile_frames = kwargs.get('profile_frames', 120)
+        self.profile_memory = kwargs.get('profile_memory', False)
+        self.sound_icons = {}
+        self.next_frame = 0
+        self.render_queue = RenderQueue()
+        self.dirty_renderer = DirtyRenderer(self.canvas, self.scaler) \
+            if kwargs.get('dirty_rects', False) else None
+        self.frame_due = None  # asyncio.Event, created in play
+        self.ticks = 0
+
+        # Dispatch tables of the events and keys
+        self.event_handlers = {
+            pygame.QUIT: self.on_quit,
+            pygame.locals.KEYDOWN: self.on_key_down,
+            pygame.locals.KEYUP: self.on_key_up,
+            pygame.locals.MOUSEBUTTONDOWN: self.on_mouse_down,
+            pygame.locals.MOUSEBUTTONUP: self.on_mouse_up,
+            }
+        self.key_down_actions = {pygame.locals.K_SPACE: self.toggle_running,
+                                 pygame.locals.K_F9: self.capture_profile}
+        self.key_up_actions = {}
+        for key, index in self.key_direction_mapping.items():
+            self.key_down_actions[key] = functools.partial(
+                self.press_direction, index)
+            self.key_up_actions[key] = functools.partial(
+                self.release_direction, index)
+        # Clear the loading bar, the map may not cover the whole screen
+        self.screen.fill((0, 0, 0))
 
     async def monitoring(self):
         """
-        An asynchronous loop function used for monitoring and debug. Data
-        entries can be added to the class-attribute monitoring_data and
-        processed and/or printed out in this function.
+        An asynchronous loop function used for monitoring and debug. It
+        collects the metrics every second.
 
         This function may also be used to check program's status and sanity.
         """
         while self.running:
             elapsed = time.time()
             await asyncio.sleep(1)
-
-            # Gather some data
-            self.monitoring_data['player-balance'] = self.player.balance
-            # all entities + player
-            self.monitoring_data['entity-number'] = len(self.grid.entities) + 1
-
             # Computing elapsed time during the asynchronous waiting time
-            elapsed = time.time() - elapsed
-
-            # Printing the whole data dictionary
-            self.monitoring_data['monitoring-interval'] = elapsed
-            print('MONITORING:')
-            for k, v in self.monitoring_data.items():
-                print('[] ' + k + ': ' + str(v))
-            print('')
-
-            # Resetting
-            for k, v in self.monitoring_data.items():
-                self.monitoring_data[k] = 0.0
+            with profiler.scope('monitoring'):
+                self.report_monitoring(time.time() - elapsed)
         print('Closed monitoring')
 
-    async def handle_mouse(self):
+    def report_monitoring(self, elapsed):
         """
-        An asynchronous loop function to handle mouse interactions.
+        Gathers the gauges, then collects the metrics of the interval.
 
-        This functions check when the user clicks and tell the game what to
-        do then.
+        :param elapsed: The time elapsed since the last report, in seconds.
         """
-        while self.running:
-            # Wait until mouse left clicks
-            # get_pressed returns a 3-tuple for left, middle and right click.
-            while self.running and not (pygame.mouse.get_focused()
-                                        and pygame.mouse.get_pressed()[0]):
-                await asyncio.sleep(self.base_delay)
-            # Get mouse position relative to top left corner of the screen
-            x, y = pygame.mouse.get_pos()
-            # If click was on the sound button
-            if self.sound_button_box.collidepoint(x, y):
-                self.toggle_sound()
-                self.monitoring_data['handled-clicks'] += 1
-            # wait until mouse unpressed
-            while self.running and pygame.mouse.get_pressed()[0]:
-                await asyncio.sleep(self.base_delay)
-            self.monitoring_data['clicks'] += 1
-            await asyncio.sleep(self.base_delay)  # avoiding too fast spam click
-        print('Closed mouse handler')
+        self.metrics.set('player-balance', self.player.balance)
+        # all entities + player
+        self.metrics.set('entity-number', len(self.grid.entities) + 1)
+        self.metrics.set('active-entities', len(self.grid.scheduler) + 1)
+        self.metrics.set('assets-loaded', assets.progress()[0])
+        pools.report(self.metrics)
+        self.metrics.collect(elapsed)
 
     async def handle_graphics(self):
         """
@@ -195,9 +344,90 @@ class LlnRpg:
         screen. This function calls all the update functions of the entities
         in the map, including the player, first, then draw.
         """
-        while self.running:
+        while True:
+            # Wait until next frame, handle_events tells when it is due
+            await self.frame_due.wait()
+            if not self.running:
+                break
+            self.frame_due.clear()
+            with profiler.scope('graphics'):
+                self.frame()
+        print('Closed graphics handler')
+
+    def frame(self):
+        """
+        Updates the game by as many ticks as the time elapsed since last
+        frame calls for, then draws and displays it. The clock tells when the
+        next frame is due.
+        """
+        clock = self.clock
+        ticks = clock.begin_frame()
+        for tick in range(ticks):
+            if self.interpolate and tick == ticks - 1:
+                self.previous_pos = {
+                    entity: entity.map_pos
+                    for entity in [self.player] + self.grid.visible_entities()}
+            self.update_world()
+        clock.lap('update')
+
+        if not self.headless:
+            if self.interpolate:
+                x, y = self.render_pos(self.player)
+                self.grid.view_coord = (self.player.screen_pos[0] - x,
+                                        self.player.screen_pos[1] - y)
+            # Animated tiles show the frame of the last tick
+            redrawn = self.grid.animate(self.ticks)
+            if self.dirty_renderer is not None:
+                self.dirty_renderer.present(self, clock, redrawn)
+            else:
+                self.draw()
+                clock.lap('draw')
+                # Actually display what was drawn
+                self.scaler.flip()
+            clock.lap('present')
+            # Prefetch the background the player walks towards
+            self.grid.stream(self.player.direction if self.player.can_move
+                             else 0)
+        # Prefetch the levels of the exits the player is close to
+        self.grid.prefetch_exits(self.player.pos)
+        self.next_frame = clock.end_frame()
+
+        metrics = self.metrics
+        if metrics.enabled:
+            self.frame_metrics.record(clock.timings)
+            if self.pending_event is not None:
+                # The handled events are shown from this frame on
+                metrics.observe('event-latency', 1e3 * (
+                    time.perf_counter() - self.pending_event))
+        self.pending_event = None
+        profiler.end_frame()
+        if self.first_frame_time is None:
+            self.first_frame_time = time.perf_counter() - self.started
+            self.metrics.set('time-to-first-frame',
+                             1e3 * self.first_frame_time)
+            print('First frame after %.0f ms' % (1e3 * self.first_frame_time))
+        if self.music_file is not None and not self.music_loaded:
+            self.load_music()
+
+    def update_world(self):
+        """
+        Advances the game by one tick: updates the player first, then the
+        view coordinates, then all the entities of the grid.
+        """
+        metrics = self.metrics
+        sampled = metrics.enabled and self.ticks % metrics.sample_period == 0
+        if sampled:
+            start = time.perf_counter()
+        with profiler.scope('update.player'):
             # Update player
             self.player.update(get_direction(self.raw_direction), self.grid)
+            # Change level when the player steps on an exit
+            if self.player.pos != self.player_tile:
+                self.player_tile = self.player.pos
+                self.grid.wake_near(self.player_tile, WAKE_RADIUS)
+                level_exit = self.grid.exit_at(self.player_tile)
+                if level_exit is not None:
+                    self.change_level(*level_exit)
 
             # Update coordinates of the view
             self.grid.view_coord = (
@@ -205,103 +435,331 @@ class LlnRpg:
                 self.player.screen_pos[1] - self.player.map_pos[1]
                 )
 
-            # Draw map in the background
-            self.screen.blit(self.grid.background, self.grid.view_coord)
-
-            # Draw player
-            self.player.blit(self.screen, self.grid.view_coord)
-
-            # Update and draw entities
-            # creating list avoids error if dict size changes, which happen
-            # when entities delete themselves
-            grid_entities = [entity for _, entity in self.grid.entities.items()]
-            for entity in grid_entities:
-                # print(entity)
-                entity.update(self.grid)
-                entity.blit(self.screen, self.grid.view_coord)
-
-            # Draw sound button
-            self.screen.blit(self.sound_button, (0, 0))
-
-            # Actually display what was drawn
-            pygame.display.flip()
-            self.monitoring_data['frames'] += 1
-            # Wait until next frame
-            await asyncio.sleep(0.015)  # This controls fps (roughly)
-        print('Closed graphics handler')
+        # Update the entities the scheduler says are due, sleeping entities
+        # cost nothing until woken up
+        grid_entities = self.grid.due_entities()
+        with profiler.scope('update.entities'):
+            if sampled:
+                # Update time of each entity type, in seconds
+                times = {'Player': time.perf_counter() - start}
+                start = time.perf_counter()
+                for entity in grid_entities:
+                    entity.update(self.grid)
+                    now = time.perf_counter()
+                    name = type(entity).__name__
+                    times[name] = times.get(name, 0.0) + now - start
+                    start = now
+            else:
+                for entity in grid_entities:
+                    entity.update(self.grid)
+        with profiler.scope('update.stores'):
+            # Update the entities of the stores all at once
+            self.grid.update_stores()
+        if sampled:
+            times['stores'] = time.perf_counter() - start
+            for name, elapsed in times.items():
+                metrics.observe('update-time.' + name, 1e3 * elapsed)
+        self.ticks += 1
+
+    def change_level(self, map_file, arrival=None):
+        """
+        Moves the player to another level. The entities of the current level
+        are removed.
+
+        :param map_file: The map file of the level.
+        :param arrival: The (x, y) tile the player arrives on, None to stay
+            on the same tile.
+        """
+        self.grid.clear_entities()
+        self.grid.setLevel(map_file)
+        self.player.set_pos(self.grid, arrival if arrival is not None
+                            else self.player.pos)
+        self.player_tile = self.player.pos
+        if self.dirty_renderer is not None:
+            self.dirty_renderer.full_redraw = True
+
+    def step(self, n_ticks, direction=None):
+        """
+        Advances the game by a fixed number of ticks, as fast as possible and
+        without drawing anything. The game state after a given sequence of
+        steps does not depend on time, which makes it suitable for
+        simulations and benchmarks.
+
+        :param n_ticks: The number of ticks to simulate.
+        :param direction: If given, the arrow keys input array to use during
+            these ticks, as in raw_direction.
+        :return: The number of ticks simulated per second.
+        """
+        if direction is not None:
+            self.raw_direction = list(direction)
+        elapsed = time.perf_counter()
+        for _ in range(n_ticks):
+            self.update_world()
+        elapsed = time.perf_counter() - elapsed
+        self.metrics.inc('ticks', n_ticks)
+        return n_ticks / elapsed if elapsed > 0 else float('inf')
+
+    def draw(self):
+        """
+        Draws the map, the player, the entities, the overhead layer of the
+        map and the sound button on the screen. Only what is on the screen
+        is drawn.
+        """
+        self.draw_background()
+        with profiler.scope('draw.entities'):
+            for _, surface, position, layer in self.drawables():
+                self.render_queue.submit(surface, position, layer)
+            for surface, position, area in self.grid.overhead_blits():
+                self.render_queue.submit(surface, position, OVERHEAD_LAYER,
+                                         area)
+            self.render_queue.flush(self.canvas)
+
+    def draw_background(self):
+        """
+        Draws the visible part of the map on the screen.
+        """
+        with profiler.scope('draw.background'):
+            self.grid.draw_background(self.canvas)
+
+    def drawables(self):
+        """
+        :return: A list of what has to be drawn over the map, in drawing
+            order: the player, the entities that may be on the screen, then
+            the sound button. Each item is a (key, surface, screen position,
+            layer) tuple, where key identifies the drawn object from one
+            frame to another.
+        """
+        vx, vy = self.grid.view_coord
+        scale = self.grid.scale
+        entities = [self.player] + self.grid.visible_entities()
+        if self.interpolate:
+            positions = [self.render_pos(entity) for entity in entities]
+        else:
+            positions = [entity.map_pos for entity in entities]
+        items = [(entity, entity.sprites[entity.current_sprite],
+                  ((x + vx) // scale, (y + vy) // scale), ENTITY_LAYER)
+                 for entity, (x, y) in zip(entities, positions)]
+        items.append(('sound_button', self.sound_button, (0, 0), UI_LAYER))
+        if self.metrics_overlay is not None:
+            overlay = self.metrics_overlay.render()
+            if overlay is not None:
+                items.append(('metrics_overlay', overlay,
+                              (self.canvas.get_width() - overlay.get_width(),
+                               0), UI_LAYER))
+        return items
+
+    def render_pos(self, entity):
+        """
+        :param entity: The entity to draw.
+        :return: The map_pos of the entity, interpolated between its
+            positions before and after the last tick by the fraction of a
+            tick elapsed since.
+        """
+        x, y = entity.map_pos
+        previous = self.previous_pos.get(entity)
+        if previous is None:
+            return x, y
+        alpha = self.clock.alpha
+        px, py = previous
+        # Entities are not interpolated when they jumped elsewhere
+        if abs(x - px) > self.grid.tilesize[0] \
+                or abs(y - py) > self.grid.tilesize[1]:
+            return x, y
+        return round(px + (x - px) * alpha), round(py + (y - py) * alpha)
 
     async def handle_events(self):
         """
-        An asynchronous loop function that process events.
+        An asynchronous loop function that process events. It sleeps until
+        the next frame is due, letting the other tasks run meanwhile, then
+        processes the events pushed so far and tells handle_graphics to draw.
+        Events are thus handled before the first frame able to show them,
+        without ever blocking the event loop.
         """
         while self.running:
-            # Poll each event pushed to the event queue
-            for event in pygame.event.get():
-
-                # Quit event
-                if event.type == pygame.QUIT:
-                    self.running = False
-                    self.monitoring_data['handled-events'] += 1
-
-                # Key pressed event, arrow key pressed
-                if event.type == pygame.locals.KEYDOWN \
-                        and event.key in self.key_direction_mapping:
-                    # Update pressed key as being the last pressed key
-                    # (in case several are pressed simultaneously)
-                    self.raw_direction[self.key_direction_mapping[
-                        event.key]] = max(self.raw_direction) + 1
-                    self.monitoring_data['handled-events'] += 1
-
-                # Key unpressed event, arrow key unpressed
-                elif event.type == pygame.locals.KEYUP \
-                        and event.key in self.key_direction_mapping:
-                    # Key is unpressed, so it should be taken into account
-                    # anymore in player direction computation
-                    self.raw_direction[self.key_direction_mapping[
-                        event.key]] = 0
-                    self.monitoring_data['handled-events'] += 1
-
-                # Key pressed event, space bar pressed
-                elif event.type == pygame.locals.KEYDOWN \
-                        and event.key == pygame.locals.K_SPACE:
-                    self.player.running = not self.player.running
-                    self.monitoring_data['handled-events'] += 1
-
-                self.monitoring_data['events'] += 1
-            self.monitoring_data['handle_events-loops'] += 1
-            await asyncio.sleep(self.base_delay)
+            with profiler.scope('events'):
+                self.poll_events()
+            timeout = self.next_frame - time.perf_counter()
+            if timeout > 0:
+                await asyncio.sleep(max(timeout, self.base_delay))
+            else:
+                self.frame_due.set()
+                # Let the other tasks run
+                await asyncio.sleep(0)
+        # Release handle_graphics so that it can exit
+        self.frame_due.set()
         print('Closed events handler')
 
-    def main(self):
+    def setup_events(self):
+        """
+        Restricts the event queue to the handled event types, so that the
+        game is not woken up by events it ignores. Must be called once pygame
+        is initialised.
+        """
+        pygame.event.set_blocked(None)
+        pygame.event.set_allowed(list(self.event_handlers))
+
+    def poll_events(self):
+        """
+        Processes every event pushed to the event queue so far.
+        """
+        # Poll each event pushed to the event queue
+        for event in pygame.event.get():
+            self.handle_event(event)
+        self.metrics.inc('handle_events-loops')
+
+    def wait_event(self, timeout):
+        """
+        Sleeps until an event is pushed to the queue, or timeout elapsed. The
+        event, if any, is processed. Blocking, thus only for play_sync.
+
+        :param timeout: The maximal time to sleep, in seconds.
+        """
+        timeout = max(timeout, self.base_delay)
+        # pygame.event.wait waits forever with a 0 timeout
+        event = pygame.event.wait(max(1, math.ceil(timeout * 1000)))
+        if event.type != pygame.NOEVENT:
+            with profiler.scope('events'):
+                self.handle_event(event)
+
+    def handle_event(self, event):
+        """
+        Dispatches an event to its handler.
+        """
+        handler = self.event_handlers.get(event.type)
+        if handler is not None:
+            handler(event)
+            if self.pending_event is None:
+                self.pending_event = time.perf_counter()
+        self.metrics.inc('events')
+
+    def on_quit(self, event):
+        self.running = False
+        self.metrics.inc('handled-events')
+
+    def on_key_down(self, event):
+        action = self.key_down_actions.get(event.key)
+        if action is not None:
+            action()
+            self.metrics.inc('handled-events')
+
+    def on_key_up(self, event):
+        action = self.key_up_actions.get(event.key)
+        if action is not None:
+            action()
+            self.metrics.inc('handled-events')
+
+    def on_mouse_down(self, event):
+        # If left click was on the sound button
+        if event.button == 1 and self.sound_button_box.collidepoint(
+                self.scaler.to_frame(event.pos)):
+            self.toggle_sound()
+            self.metrics.inc('handled-clicks')
+
+    def on_mouse_up(self, event):
+        if event.button == 1:
+            self.metrics.inc('clicks')
+
+    def press_direction(self, index):
+        """
+        Arrow key pressed.
+
+        :param index: The index of the key's direction in raw_direction.
+        """
+        # Update pressed key as being the last pressed key
+        # (in case several are pressed simultaneously)
+        self.raw_direction[index] = max(self.raw_direction) + 1
+
+    def release_direction(self, index):
+        """
+        Arrow key released.
+
+        :param index: The index of the key's direction in raw_direction.
+        """
+        # Key is unpressed, so it should be taken into account
+        # anymore in player direction computation
+        self.raw_direction[index] = 0
+
+    def capture_profile(self):
+        """
+        F9 pressed, profiles the next profile_frames frames with cProfile, and
+        dumps the profile to a timestamped file of the working directory.
+        """
+        profiler.capture(self.profile_frames,
+                         time.strftime('profile-%Y%m%d-%H%M%S'),
+                         self.profile_memory)
+
+    def toggle_running(self):
+        """
+        Space bar pressed, the player starts or stops running.
+        """
+        self.player.running = not self.player.running
+
+    async def play(self):
+        """
+        Runs the game by gathering all its asynchronous loop functions in a
+        single awaitable, until the game stops running.
+        """
+        self.running = True
+        self.frame_due = asyncio.Event()
+        loops = [self.handle_events(), self.handle_graphics(),
+                 self.monitoring()]
+        if profiler.enabled:
+            loops.append(profiler.loop_lag(lambda: self.running))
+        await asyncio.gather(*loops)
+
+    def play_sync(self):
+        """
+        Runs the game in a single synchronous loop, until the game stops
+        running. This is the synchronous equivalent of play: each iteration
+        processes events, then draws a frame if it is due, or sleeps until an
+        event happens or the frame is due.
+        """
+        self.running = True
+        last_monitoring = time.time()
+        while self.running:
+            with profiler.scope('events'):
+                self.poll_events()
+            timeout = self.next_frame - time.perf_counter()
+            if timeout > 0:
+                self.wait_event(timeout)
+            else:
+                with profiler.scope('graphics'):
+                    self.frame()
+            now = time.time()
+            if now - last_monitoring >= 1:
+                with profiler.scope('monitoring'):
+                    self.report_monitoring(now - last_monitoring)
+                last_monitoring = now
+
+    def main(self, synchronous=False):
         """
         Main function that initiates and runs the game. Launch asynchronous
         tasks and wait them to finish.
+
+        :param synchronous: True to run the game in a single synchronous loop
+            instead of asynchronous tasks (False).
         """
         pygame.init()
         pygame.display.set_caption("RPG - Louvain-la-Neuve")
 
-        # Draw the map on the screen, as a background
-        self.screen.blit(self.grid.background, self.grid.view_coord)
-        pygame.display.flip()
+        if not self.headless:
+            # Draw the map on the screen, as a background
+            self.draw_background()
+            self.scaler.flip()
 
-        # load music
-        pygame.mixer.init()
-        pygame.mixer.music.load("sound/lln_sound.wav")
+        if self.music_file is not None:
+            # The music itself is loaded once read, see load_music
+            pygame.mixer.init()
         self.toggle_sound()
-
-        async def gather_tasks():
-            # Inner function to gather all coroutines in a single awaitable.
-            await asyncio.gather(
-                self.handle_events(),
-                self.handle_mouse(),
-                self.handle_graphics(),
-                self.monitoring()
-                )
+        self.setup_events()
 
         # Start running the game
-        self.running = True
-
-        asyncio.run(gather_tasks())
+        if synchronous:
+            self.play_sync()
+        else:
+            asyncio.run(self.play())
+        # Write the last metrics
+        self.metrics.close()
         print('Exit main')
 
     def toggle_sound(self):
@@ -309,22 +767,98 @@ class LlnRpg:
         Toggles the sound playing and the appearance of the corresponding
         button at each call.
         """
-        if self.sound_played:
-            self.sound_button = pygame.image.load("images/no_sound_icon.png")
-            self.sound_button = pygame.transform.scale(self.sound_button,
-                                                       (32, 32))
-            pygame.mixer.music.stop()
-            self.sound_played = False
-        else:
-            self.sound_button = pygame.image.load("images/sound_icon.png")
-            self.sound_button = pygame.transform.scale(self.sound_button,
-                                                       (32, 32))
-            pygame.mixer.music.play(-1, 0.0)
-            self.sound_played = True
+        self.sound_played = not self.sound_played
+        self.sound_button = self.sound_icon(self.sound_played)
+        if self.music_loaded:
+            if self.sound_played:
+                pygame.mixer.music.play(-1, 0.0)
+            else:
+                pygame.mixer.music.stop()
         if self.sound_button_box is None:
             self.sound_button_box = self.sound_button.get_rect()
 
+    def sound_icon(self, played):
+        """
+        :param played: True for the icon of played sound, False for muted.
+        :return: The icon of the sound button, loaded and scaled only once.
+        """
+        icon = self.sound_icons.get(played)
+        if icon is None:
+            icon = pygame.transform.scale(
+                assets.image(SOUND_ICONS[played]).convert_alpha(),
+                (32 // self.grid.scale, 32 // self.grid.scale))
+            self.sound_icons[played] = icon
+        return icon
+
+    def load_music(self):
+        """
+        Loads the music if its file was read, and starts playing it if sound
+        is played. The music is optional: the game runs without it if it
+        could not be read.
+        """
+        future = assets.load_data(self.music_file)
+        if not future.done():
+            return
+        try:
+            # Kept, pygame streams the music from it
+            self.music_data = io.BytesIO(future.result())
+            pygame.mixer.music.load(self.music_data)
+        except (OSError, pygame.error) as e:
+            print('Music not loaded: %s' % e)
+            self.music_file = None
+            return
+        self.music_loaded = True
+        if self.sound_played:
+            pygame.mixer.music.play(-1, 0.0)
+
+    def draw_loading(self):
+        """
+        Shows the loading progress of the assets on the screen, as a bar.
+        """
+        if self.headless:
+            return
+        loaded, requested = assets.progress()
+        width, height = self.screen.get_size()
+        bar = pygame.Rect(width // 4, height // 2 - 4, width // 2, 8)
+        self.screen.fill((0, 0, 0))
+        pygame.draw.rect(self.screen, (255, 255, 255), bar, 1)
+        bar.width = bar.width * loaded // max(1, requested)
+        self.screen.fill((255, 255, 255), bar)
+        pygame.display.flip()
+
 
 if __name__ == "__main__":
-    game = LlnRpg()
-    game.main()
+    parser = argparse.ArgumentParser(description='RPG - Louvain-la-Neuve')
+    parser.add_argument('--sync', action='store_true',
+                        help='run the game in a synchronous loop instead of '
+                             'asynchronous tasks')
+    parser.add_argument('--dirty-rects', action='store_true',
+                        help='update only the parts of the screen that '
+                             'changed')
+    parser.add_argument('--headless', type=int, metavar='TICKS',
+                        help='simulate TICKS ticks without display nor sound, '
+                             'then print the simulation speed')
+    parser.add_argument('--metrics', metavar='FILE',
+                        help='write the metrics to FILE every second, as CSV '
+                             'if it ends with .csv, as JSON lines otherwise')
+    parser.add_argument('--overlay', action='store_true',
+                        help='show the main metrics on the screen')
+    parser.add_argument('--scale', type=int, metavar='N',
+                        help='draw the game N times smaller than the window, '
+                             'then upscale it')
+    parser.add_argument('--smooth', action='store_true',
+                        help='upscale with smooth filtering instead of '
+                             'nearest neighbour')
+    parser.add_argument('--profile', action='store_true',
+                        help='time the loops and frame phases into the '
+                             'metrics, and monitor the event loop lag')
+    args = parser.parse_args()
+    if args.headless is None:
+        options = {} if args.scale is None else {'render_scale': args.scale}
+        game = LlnRpg(dirty_rects=args.dirty_rects, metrics_file=args.metrics,
+                      metrics_overlay=args.overlay, profile=args.profile,
+                      smooth_scaling=args.smooth, **options)
+        game.main(args.sync)
+    else:
+        game = LlnRpg(headless=True)
+        print('%.1f ticks/s' % game.step(args.headless))
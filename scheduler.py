@@ -0,0 +1,147 @@
+import heapq
+import itertools
+
+
+class Scheduler:
+    """
+    Schedules the updates of the entities of a grid, so that only entities
+    that have something to do are updated on each tick.
+
+    Entities are either active, and updated every period ticks (1 by
+    default, every tick), or sleeping, and not updated at all. A sleeping
+    entity is woken up explicitly, by an event of the game (it is collected,
+    something comes close...), or by a timer when it went to sleep for a
+    given number of ticks. Timers are kept in a heap, so that only the due
+    ones are looked at.
+
+    Active entities updated every period ticks are spread over the period,
+    so that the cost of their updates is spread over the ticks too.
+
+    :tick: The number of ticks scheduled so far.
+    """
+
+    def __init__(self):
+        self.tick = 0
+        # entity -> (period, phase) of every scheduled entity
+        self._schedule = {}
+        # period -> list of, for each phase, the dict of the active entities
+        # updated on the ticks of this phase (dict as an ordered set)
+        self._groups = {1: [{}]}
+        # period -> number of entities given a phase of this period so far
+        self._phases = {}
+        self._sleeping = set()
+        # Heap of the (tick, sequence number, entity) wake-up timers, and
+        # the sequence number of the pending timer of each entity
+        self._timers = []
+        self._timer_of = {}
+        self._sequence = itertools.count()
+
+    def __len__(self):
+        """
+        :return: The number of active entities.
+        """
+        return len(self._schedule) - len(self._sleeping)
+
+    def add(self, entity, period=1):
+        """
+        Schedules an entity, active.
+
+        :param period: The number of ticks between two updates of the entity.
+        """
+        self._schedule[entity] = period, None
+        self._activate(entity)
+
+    def remove(self, entity):
+        """
+        Stops scheduling an entity.
+        """
+        if entity not in self._schedule:
+            return
+        if entity in self._sleeping:
+            self._sleeping.remove(entity)
+        else:
+            self._deactivate(entity)
+        del self._schedule[entity]
+        self._timer_of.pop(entity, None)
+
+    def _activate(self, entity):
+        period, _ = self._schedule[entity]
+        groups = self._groups.get(period)
+        if groups is None:
+            groups = self._groups[period] = [{} for _ in range(period)]
+        # Phases are given in turn, to spread the entities over the period
+        count = self._phases.get(period, 0)
+        self._phases[period] = count + 1
+        phase = count % period
+        groups[phase][entity] = None
+        self._schedule[entity] = period, phase
+
+    def _deactivate(self, entity):
+        period, phase = self._schedule[entity]
+        del self._groups[period][phase][entity]
+
+    def set_period(self, entity, period):
+        """
+        Sets the number of ticks between two updates of an entity, such as 4
+        to update a distant entity at a quarter of the rate. The entity
+        should take it into account if its update depends on time.
+        """
+        if entity not in self._schedule or \
+                self._schedule[entity][0] == period:
+            return
+        if entity in self._sleeping:
+            self._schedule[entity] = period, None
+            return
+        self._deactivate(entity)
+        self._schedule[entity] = period, None
+        self._activate(entity)
+
+    def sleep(self, entity, ticks=None):
+        """
+        Stops updating an entity until it is woken up.
+
+        :param ticks: If given, the entity is woken up after this number of
+            ticks, unless it is woken up before.
+        """
+        if entity not in self._schedule:
+            return
+        if entity not in self._sleeping:
+            self._deactivate(entity)
+            self._sleeping.add(entity)
+        if ticks is None:
+            self._timer_of.pop(entity, None)
+        else:
+            sequence = next(self._sequence)
+            self._timer_of[entity] = sequence
+            heapq.heappush(self._timers, (self.tick + ticks, sequence, entity))
+
+    def wake(self, entity):
+        """
+        Updates a sleeping entity again, from the next tick on.
+        """
+        if entity in self._sleeping:
+            self._sleeping.remove(entity)
+            self._timer_of.pop(entity, None)
+            self._activate(entity)
+
+    def is_sleeping(self, entity):
+        return entity in self._sleeping
+
+    def due(self):
+        """
+        Starts a new tick: wakes up the entities whose timer expired.
+
+        :return: The list of the entities to update on this tick.
+        """
+        tick = self.tick
+        self.tick += 1
+        timers = self._timers
+        while timers and timers[0][0] <= tick:
+            _, sequence, entity = heapq.heappop(timers)
+            # Timers of entities woken up or put to sleep again are stale
+            if self._timer_of.get(entity) == sequence:
+                self.wake(entity)
+        due = []
+        for period, groups in self._groups.items():
+            due.extend(groups[tick % period])
+        return due
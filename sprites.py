@@ -0,0 +1,114 @@
+import pygame
+
+from assets import assets
+
+# Process-wide sprite cache, (file, nx, ny, sprite_size, atlas) -> tuple of
+# sprites
+_cache = {}
+
+
+class SpriteAtlas:
+    """
+    A texture atlas: sprites are packed into a few large surfaces (pages),
+    and handled as subsurfaces of them, so that many sprites share a single
+    texture.
+
+    Sprites are packed in rows (shelves), a new page is started when the
+    current one is full.
+
+    :page_size: The size of the pages, in pixels.
+    :pages: The list of the pages' surfaces.
+    """
+
+    def __init__(self, page_size=(1024, 1024)):
+        self.page_size = page_size
+        self.pages = []
+        self._x = self._y = self._row_height = 0
+
+    def add(self, surface):
+        """
+        Copies a surface into the atlas.
+
+        :param surface: The surface to add, with per-pixel alpha.
+        :return: The subsurface of the atlas holding the copy.
+        """
+        width, height = surface.get_size()
+        page_width, page_height = self.page_size
+        if width > page_width or height > page_height:
+            # Too big to be packed, keep it in its own surface
+            return surface
+        if self._x + width > page_width:
+            # Next row
+            self._x = 0
+            self._y += self._row_height
+            self._row_height = 0
+        if not self.pages or self._y + height > page_height:
+            # Next page
+            self.pages.append(pygame.Surface(
+                self.page_size, pygame.SRCALPHA).convert_alpha())
+            self.pages[-1].fill((0, 0, 0, 0))
+            self._x = self._y = self._row_height = 0
+        page = self.pages[-1]
+        rect = pygame.Rect(self._x, self._y, width, height)
+        # Copies pixels and alpha as they are onto the transparent page
+        page.blit(surface, rect, special_flags=pygame.BLEND_RGBA_MAX)
+        self._x += width
+        self._row_height = max(self._row_height, height)
+        return page.subsurface(rect)
+
+
+def load_sprites(sprites_file, nx, ny, sprite_size, scale=1, atlas=None):
+    """
+    Loads the sprites found in a file, rescaled to sprite_size divided by
+    scale. Sprites are supposed to be aligned in a grid, and to have the
+    exact same size in pixels. Sprites are cached: the file is decoded and
+    its sprites scaled only once, and every call with the same arguments
+    returns the same surfaces, which must thus not be modified.
+
+    :param sprites_file: An image file containing sprites
+    :param nx: number of sprite in the horizontal direction.
+    :param ny: number of sprite in the vertical direction.
+    :param sprite_size: A 2-tuple of the size the sprites are rescaled to.
+    :param scale: The integer factor the sprites are scaled down by, the
+        scale of the low resolution frame they are drawn on (see
+        render.FrameScaler), 1 to load them at their full size.
+    :param atlas: The SpriteAtlas the sprites are packed into, None to keep
+        each of them in its own surface.
+    :return: A tuple of the sprites, row by row.
+    """
+    key = (sprites_file, nx, ny,
+           (int(sprite_size[0]) // scale, int(sprite_size[1]) // scale), atlas)
+    try:
+        return _cache[key]
+    except KeyError:
+        pass
+    # Load image from file, or get it from the assets if it was preloaded
+    image = assets.image(sprites_file).convert_alpha()
+    image_width, image_height = image.get_size()
+    # Size of sprites in file
+    size_x = int(image_width / nx)
+    size_y = int(image_height / ny)
+    sprites = []
+    for y in range(ny):
+        for x in range(nx):
+            # top left corner coordinates, x & y dimension
+            rect = (size_x * x, size_y * y, size_x, size_y)
+            surf = image.subsurface(rect)
+            # Rescale the sprite in desired rect box to desired size, unless
+            # it is drawn at its native size
+            if surf.get_size() != key[3]:
+                surf = pygame.transform.smoothscale(surf, key[3])
+            else:
+                surf = surf.copy()
+            if atlas is not None:
+                surf = atlas.add(surf)
+            sprites.append(surf)
+    sprites = _cache[key] = tuple(sprites)
+    return sprites
+
+
+def clear_cache():
+    """
+    Empties the sprite cache.
+    """
+    _cache.clear()
@@ -0,0 +1,463 @@
+import numpy
+
+from entities import Coin, Entity
+
+# Kinds of the entities of a store
+MOVER = 0
+COIN = 1
+
+# Tile offset of each direction, 0: NONE, 1: UP, 2: DOWN, 3: LEFT, 4: RIGHT
+DIRECTION_DX = numpy.array([0, 0, 0, -1, 1], numpy.int32)
+DIRECTION_DY = numpy.array([0, -1, 1, 0, 0], numpy.int32)
+# Sprites of the movers, as in Movable.postures, by direction - 1
+WALKING_SPRITES = numpy.array([[0, 1, 2, 1],
+                               [3, 4, 5, 4],
+                               [6, 7, 8, 7],
+                               [9, 10, 11, 10]], numpy.int16)
+STILL_SPRITES = numpy.array([1, 4, 7, 10], numpy.int16)
+
+
+class EntityStore:
+    """
+    A struct-of-arrays storage for large crowds of simple entities: movers
+    (non player characters) and coins. The state of all the entities is kept
+    in NumPy arrays and updated at once by a vectorized update, instead of
+    calling the update function of every entity object.
+
+    Entities of a store are handled through thin proxy objects (StoredMover
+    and StoredCoin) providing the Entity API on top of the arrays. Stores are
+    added to a grid with Grid.add_store, the grid then includes their
+    entities in its lookups.
+
+    Movers follow the rules of Movable.update: they change direction and
+    tile only when precisely fitting onto a tile, and move speed pixels per
+    tick towards their direction unless the next tile is blocked. They walk
+    while moving and stand still otherwise. Coins behave like Coin.
+
+    :grid: The grid the entities belong to.
+    :size: The number of slots in use or free in the arrays.
+    :kind: The kind of each entity, MOVER or COIN.
+    :used: True for the slots holding an entity.
+    :pos: Position on the map in tile, (-1, -1) when not on any tile.
+    :map_pos: Position on the map in screen pixel.
+    :direction: Current direction, as Movable._direction.
+    :old_direction: Last non-zero direction, as Movable._old_direction.
+    :target: The direction movers will take on their next tile, as the
+        direction argument of Movable.update.
+    :speed: Current speed in pixel per tick.
+    :base_speed: Speed movers take each time they fit onto a tile.
+    :current_sprite: The index of the current sprite.
+    :sprites_speed: As Entity.sprites_speed.
+    :frame_counter: Frames left before a coin's next animation step.
+    :jump_counter: Step of the jump animation of collected coins.
+    :jumping: True for the collected coins still animating.
+    :alive: False once a coin has been collected.
+    :value: The value of each coin.
+    :sprites: The list of the sprites list of each entity.
+    """
+
+    def __init__(self, grid, capacity=1024):
+        self.grid = grid
+        self.size = 0
+        self._free = []
+        self._proxies = []
+        self.sprites = []
+        self.kind = numpy.zeros(capacity, numpy.uint8)
+        self.used = numpy.zeros(capacity, bool)
+        self.pos = numpy.full((capacity, 2), -1, numpy.int32)
+        self.map_pos = numpy.zeros((capacity, 2), numpy.int32)
+        self.direction = numpy.zeros(capacity, numpy.int8)
+        self.old_direction = numpy.ones(capacity, numpy.int8)
+        self.target = numpy.zeros(capacity, numpy.int8)
+        self.speed = numpy.zeros(capacity, numpy.int32)
+        self.base_speed = numpy.zeros(capacity, numpy.int32)
+        self.current_sprite = numpy.zeros(capacity, numpy.int16)
+        self.sprites_speed = numpy.ones(capacity, numpy.int32)
+        self.frame_counter = numpy.zeros(capacity, numpy.int32)
+        self.jump_counter = numpy.zeros(capacity, numpy.int32)
+        self.jumping = numpy.zeros(capacity, bool)
+        self.alive = numpy.zeros(capacity, bool)
+        self.value = numpy.zeros(capacity, numpy.int32)
+
+    def __len__(self):
+        return self.size - len(self._free)
+
+    def _grow(self):
+        """
+        Doubles the capacity of the arrays.
+        """
+        for name in ('kind', 'used', 'pos', 'map_pos', 'direction',
+                     'old_direction', 'target', 'speed', 'base_speed',
+                     'current_sprite', 'sprites_speed', 'frame_counter',
+                     'jump_counter', 'jumping', 'alive', 'value'):
+            array = getattr(self, name)
+            grown = numpy.zeros((2 * len(array),) + array.shape[1:],
+                                array.dtype)
+            grown[:len(array)] = array
+            setattr(self, name, grown)
+        self.pos[self.size:] = -1
+        self.old_direction[self.size:] = 1
+        self.sprites_speed[self.size:] = 1
+
+    def _allocate(self, kind, pos, sprites):
+        if self._free:
+            index = self._free.pop()
+        else:
+            if self.size == len(self.used):
+                self._grow()
+            index = self.size
+            self.size += 1
+            self._proxies.append(None)
+            self.sprites.append(None)
+        tile_w, tile_h = self.grid.tilesize
+        self.kind[index] = kind
+        self.used[index] = True
+        self.alive[index] = True
+        self.pos[index] = pos
+        self.map_pos[index] = pos[0] * tile_w, pos[1] * tile_h
+        self.direction[index] = 0
+        self.old_direction[index] = 1
+        self.target[index] = 0
+        self.speed[index] = self.base_speed[index] = 0
+        self.current_sprite[index] = 0
+        self.sprites_speed[index] = 1
+        self.frame_counter[index] = 0
+        self.jump_counter[index] = 0
+        self.jumping[index] = False
+        self.value[index] = 0
+        self.sprites[index] = [] if sprites is None else sprites
+        return index
+
+    def add_mover(self, pos, speed, sprites=None, direction=0,
+                  sprite_speed=1):
+        """
+        Adds a mover to the store.
+
+        :param pos: Position on the map in tile.
+        :param speed: The speed in pixel per tick of the mover.
+        :param sprites: The list of sprites of the mover, ordered as for a
+            Movable.
+        :param direction: The direction the mover will take.
+        :param sprite_speed: As Entity.sprites_speed.
+        :return: The StoredMover proxy of the new mover.
+        """
+        index = self._allocate(MOVER, pos, sprites)
+        self.speed[index] = self.base_speed[index] = speed
+        self.target[index] = direction
+        self.sprites_speed[index] = sprite_speed
+        self.current_sprite[index] = STILL_SPRITES[0]
+        proxy = self._proxies[index] = StoredMover(self, index)
+        return proxy
+
+    def add_coin(self, pos, value, sprites=None):
+        """
+        Adds a coin to the store.
+
+        :param pos: Position on the map in tile.
+        :param value: The value of the coin.
+        :param sprites: The list of sprites of the coin.
+        :return: The StoredCoin proxy of the new coin.
+        """
+        index = self._allocate(COIN, pos, sprites)
+        self.value[index] = value
+        proxy = self._proxies[index] = StoredCoin(self, index)
+        return proxy
+
+    def remove(self, indices):
+        """
+        Removes entities from the store. Their proxies are no longer valid.
+
+        :param indices: An index or an array-like of indices of entities.
+        """
+        for index in numpy.atleast_1d(indices).tolist():
+            if not self.used[index]:
+                continue
+            self.used[index] = False
+            self.jumping[index] = False
+            self.pos[index] = -1
+            self.sprites[index] = None
+            proxy = self._proxies[index]
+            if proxy is not None:
+                proxy.index = None
+                self._proxies[index] = None
+            self._free.append(index)
+
+    def proxies(self, indices):
+        """
+        :param indices: An array-like of indices of entities.
+        :return: The list of the proxies of these entities.
+        """
+        return [self._proxies[index] for index in indices.tolist()]
+
+    def entities_at(self, tile, kind=None):
+        """
+        :param tile: A 2-tuple of integers, the tile to look at.
+        :param kind: If given, only proxies that are instances of this class
+            (or tuple of classes) are returned.
+        :return: The list of the proxies of the entities standing on the tile.
+        """
+        if tile is None:
+            return []
+        pos = self.pos[:self.size]
+        mask = (pos[:, 0] == tile[0]) & (pos[:, 1] == tile[1])
+        found = self.proxies(numpy.flatnonzero(mask))
+        if kind is not None:
+            found = [proxy for proxy in found if isinstance(proxy, kind)]
+        return found
+
+    def entities_in_rect(self, rect, kind=None):
+        """
+        :param rect: A (x, y, width, height) rectangle in tiles.
+        :param kind: If given, only proxies that are instances of this class
+            (or tuple of classes) are returned.
+        :return: The list of the proxies of the entities whose map_pos is in
+            the rectangle, including the entities not on any tile.
+        """
+        x, y, w, h = rect
+        tile_w, tile_h = self.grid.tilesize
+        map_pos = self.map_pos[:self.size]
+        mask = self.used[:self.size] \
+            & (map_pos[:, 0] >= x * tile_w) \
+            & (map_pos[:, 0] < (x + w) * tile_w) \
+            & (map_pos[:, 1] >= y * tile_h) \
+            & (map_pos[:, 1] < (y + h) * tile_h)
+        found = self.proxies(numpy.flatnonzero(mask))
+        if kind is not None:
+            found = [proxy for proxy in found if isinstance(proxy, kind)]
+        return found
+
+    def update(self):
+        """
+        Updates all the entities of the store by one tick.
+        """
+        used = self.used[:self.size]
+        kind = self.kind[:self.size]
+        movers = used & (kind == MOVER)
+        if movers.all():
+            # Only movers, work on views of the arrays instead of copies
+            self.update_movers(slice(0, self.size))
+        elif movers.any():
+            self.update_movers(numpy.flatnonzero(movers))
+        coins = numpy.flatnonzero(used & (kind == COIN))
+        if len(coins):
+            self.update_coins(coins)
+
+    def update_movers(self, idx):
+        """
+        Vectorized equivalent of Movable.update for the given movers.
+        Conditional updates are written as arithmetic blends
+        (a + mask * (b - a)), much faster than numpy.where or boolean
+        indexing on random masks.
+
+        :param idx: The array of the indices (or the slice) of the movers to
+            update.
+        """
+        tile_w, tile_h = self.grid.tilesize
+        map_pos = self.map_pos[idx]
+        map_x, map_y = map_pos[:, 0], map_pos[:, 1]
+        pos = self.pos[idx]
+        pos_x, pos_y = pos[:, 0], pos[:, 1]
+        direction = self.direction[idx].astype(numpy.int32)
+        old_direction = self.old_direction[idx].astype(numpy.int32)
+        speed = self.speed[idx]
+
+        # Offset from the position fitting precisely into a tile, along the
+        # moving axis (x for LEFT and RIGHT, y for UP and DOWN)
+        moving = direction != 0
+        current = direction + ~moving * old_direction
+        horizontal = current > 2
+        tile_x = map_x // tile_w
+        tile_y = map_y // tile_h
+        offset_x = map_x - tile_x * tile_w
+        offset_y = map_y - tile_y * tile_h
+        aligned = offset_y + horizontal * (offset_x - offset_y) == 0
+
+        # Snap position along the moving axis, then take the new direction
+        # and speed, on aligned movers only
+        pos_x += (aligned & horizontal) * (tile_x - pos_x)
+        pos_y += (aligned & ~horizontal) * (tile_y - pos_y)
+        old_direction += (aligned & moving) * (direction - old_direction)
+        direction += aligned * (self.target[idx] - direction)
+        speed += aligned * (self.base_speed[idx] - speed)
+
+        # Move towards direction if the next tile is not blocked
+        dx = (direction == 4).view(numpy.int8) - (direction == 3)
+        dy = (direction == 2).view(numpy.int8) - (direction == 1)
+        can_move = (direction != 0) & ~self.grid.level.are_blocked(
+            pos_x + dx, pos_y + dy)
+        step = speed * can_move
+        map_x += dx * step
+        map_y += dy * step
+
+        # Update current sprite
+        current = direction + (direction == 0) * old_direction - 1
+        vertical = current < 2
+        coord = map_x + vertical * (map_y - map_x)
+        size = tile_w + vertical * (tile_h - tile_w)
+        frame = coord * self.sprites_speed[idx] // size \
+            % WALKING_SPRITES.shape[1]
+        still = STILL_SPRITES[current]
+        walking = WALKING_SPRITES.ravel()[
+            current * WALKING_SPRITES.shape[1] + frame]
+        self.current_sprite[idx] = still + can_move * (walking - still)
+
+        if not isinstance(idx, slice):
+            self.map_pos[idx] = map_pos
+            self.pos[idx] = pos
+            self.speed[idx] = speed
+        self.direction[idx] = direction
+        self.old_direction[idx] = old_direction
+
+    def update_coins(self, idx):
+        """
+        Vectorized equivalent of Coin.update for the given coins.
+
+        :param idx: The array of the indices of the coins to update.
+        """
+        counter = self.frame_counter[idx]
+        due = counter <= 0
+        self.frame_counter[idx] = numpy.where(due, self.sprites_speed[idx],
+                                              counter - 1)
+        jumping = idx[due & self.jumping[idx]]
+        jump = self.jump_counter[jumping]
+        rising = jump < 6
+        self.map_pos[jumping[rising], 1] += jump[rising]
+        self.jump_counter[jumping[rising]] += 1
+        self.remove(jumping[~rising])
+
+
+class StoredEntity(Entity):
+    """
+    A proxy giving access to an entity of an EntityStore through the Entity
+    API. Proxies are no longer valid once their entity is removed from the
+    store (index is then None).
+
+    :store: The EntityStore holding the entity.
+    :index: The index of the entity in the store's arrays.
+    """
+
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+        self.handle = None
+        self._pool = None
+        self.sprite_size = None
+
+    @property
+    def pos(self):
+        x, y = self.store.pos[self.index].tolist()
+        return None if x < 0 else (x, y)
+
+    @pos.setter
+    def pos(self, pos):
+        self.store.pos[self.index] = (-1, -1) if pos is None else pos
+
+    @property
+    def map_pos(self):
+        return tuple(self.store.map_pos[self.index].tolist())
+
+    @map_pos.setter
+    def map_pos(self, map_pos):
+        self.store.map_pos[self.index] = map_pos
+
+    @property
+    def current_sprite(self):
+        return int(self.store.current_sprite[self.index])
+
+    @current_sprite.setter
+    def current_sprite(self, current_sprite):
+        self.store.current_sprite[self.index] = current_sprite
+
+    @property
+    def sprites_speed(self):
+        return int(self.store.sprites_speed[self.index])
+
+    @sprites_speed.setter
+    def sprites_speed(self, sprites_speed):
+        self.store.sprites_speed[self.index] = sprites_speed
+
+    @property
+    def sprites(self):
+        return self.store.sprites[self.index]
+
+    @sprites.setter
+    def sprites(self, sprites):
+        self.store.sprites[self.index] = sprites
+
+    @property
+    def alive(self):
+        return bool(self.store.alive[self.index])
+
+    @alive.setter
+    def alive(self, alive):
+        self.store.alive[self.index] = alive
+
+    def update(self, grid):
+        """
+        Stored entities are updated all at once by EntityStore.update.
+        """
+        pass
+
+
+class StoredMover(StoredEntity):
+    """
+    A proxy to a mover of an EntityStore.
+    """
+
+    @property
+    def direction(self):
+        """
+        Direction property getter, as Movable.direction.
+        """
+        direction = int(self.store.direction[self.index])
+        return direction or int(self.store.old_direction[self.index])
+
+    @direction.setter
+    def direction(self, direction):
+        """
+        Direction property setter. The mover takes this direction once it
+        fits onto a tile, as with the direction argument of Movable.update.
+        """
+        self.store.target[self.index] = direction
+
+    @property
+    def speed(self):
+        return int(self.store.base_speed[self.index])
+
+    @speed.setter
+    def speed(self, speed):
+        self.store.base_speed[self.index] = speed
+
+
+class StoredCoin(StoredEntity, Coin):
+    """
+    A proxy to a coin of an EntityStore.
+    """
+
+    @property
+    def value(self):
+        return int(self.store.value[self.index])
+
+    @value.setter
+    def value(self, value):
+        self.store.value[self.index] = value
+
+    def collect(self, collector):
+        """
+        Collect this coin and put it in collector's balance, as Coin.collect.
+
+        :param collector: The collector entity.
+        :return: True if collector collected entity, False if failed.
+        """
+        if self.index is None or not self.alive:
+            return False
+        try:
+            collector.balance += self.value
+        except AttributeError:
+            return False
+        store, index = self.store, self.index
+        store.jump_counter[index] = -6
+        store.jumping[index] = True
+        store.pos[index] = -1
+        store.alive[index] = False
+        return True